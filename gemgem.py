@@ -20,11 +20,19 @@ with the following keys:
                 this gem uses.
 """
 
-import random, time, pygame, sys, copy
-from pygame.locals import *
+import random, time, sys, signal, os, json, struct
 from optparse import OptionParser
 import math
 import datetime
+from array import array
+from collections import OrderedDict, deque
+import multiprocessing
+import mmap, hashlib, string
+import threading
+try:
+    import fcntl
+except ImportError: # not available on Windows; result files are then not locked
+    fcntl = None
 
 FPS = 20000 # frames per second to update the screen
 WINDOWWIDTH = 600  # width of the program's window, in pixels
@@ -33,6 +41,10 @@ WINDOWHEIGHT = 600 # height in pixels
 BOARDWIDTH = 8 # how many columns in the board
 BOARDHEIGHT = 8 # how many rows in the board
 GEMIMAGESIZE = 64 # width & height of each space in pixels
+MAXBOARDSIZE = 64 # largest number of columns or rows in the board
+MAXBOARDPIXELS = 512 # largest width or height of the drawn board, in pixels
+MINGEMIMAGESIZE = 8 # smallest width & height of each space, in pixels
+WINDOWMARGIN = 44 # smallest space between the board and the window's edges
 
 # NUMGEMIMAGES is the number of gem types. You will need .png image
 # files named gem0.png, gem1.png, etc. up to gem(N-1).png.
@@ -43,7 +55,8 @@ assert NUMGEMIMAGES >= 4 # game needs at least 5 types of gems to work
 # a match is made. The .wav files are named match0.wav, match1.wav, etc.
 NUMMATCHSOUNDS = 6
 
-MOVERATE = 25 # 1 to 100, larger num means faster animations
+ANIMATIONTIME = 0.13 # seconds a swap, or a fall of one space, takes to animate
+FASTFORWARD = False # if True, skip the animations and only draw settled boards
 DEDUCTSPEED = 0.8 # reduces score by 1 point every DEDUCTSPEED seconds.
 
 #             R    G    B
@@ -63,7 +76,8 @@ SCORECOLOR = BROWN # color of the text for the player's score
 MOVESCOLOR =  RED # color of the text for the number of moves
 
 # The amount of space to the sides of the board to the edge of the window
-# is used several times, so calculate it once here and store in variables.
+# is used several times, so calculate it once here and store in variables
+# (setBoardSize() recalculates it, along with the window layout).
 XMARGIN = int((WINDOWWIDTH - GEMIMAGESIZE * BOARDWIDTH) / 2)
 YMARGIN = int((WINDOWHEIGHT - GEMIMAGESIZE * BOARDHEIGHT) / 2)
 
@@ -74,29 +88,674 @@ LEFT = 'left'
 RIGHT = 'right'
 
 EMPTY_SPACE = -1 # an arbitrary, nonpositive value
+EMPTY_CHAR = array('b', [EMPTY_SPACE]).tostring() # EMPTY_SPACE in a Board.key()
 ROWABOVEBOARD = 'row above board' # an arbitrary, noninteger value
 
 SMART_GREEDY = 'smart_greedy'
 STUPID_GREEDY = 'stupid_greedy'
 LBFS = 'lbfs'
-ALGOS = {1:STUPID_GREEDY, 2:SMART_GREEDY, 3:LBFS}
+BEAM = 'beam'
+MCTS = 'mcts'
+ALGOS = {1:STUPID_GREEDY, 2:SMART_GREEDY, 3:LBFS, 4:BEAM, 5:MCTS}
+
+# The parts of the solvers' heuristic, in the order of the weights.
+HEURISTIC_NAMES = ('score', 'pairs', 'nmoves', 'depth', 'touching')
 
 GOAL_SCORE = 100
 SEND_MULTIPLE = False
 
+CACHE_MB = 0 # default memory cap of the solver's move cache, in megabytes (0 disables it)
+SHARED_CACHE_MB = 256 # default size of a new shared move cache file, in megabytes
+SHARED_CACHE_CELLS = 64 # largest board (in spaces) a new shared move cache file can hold
+FEATURESREACH = 3 # farthest space (in each direction) a space's heuristic counts depend on
+BEAM_WIDTH = 8 # default number of states the beam search keeps per depth
+BEAM_DEPTH = 3 # default number of moves the beam search looks ahead
+MCTS_MS = 100 # default milliseconds of tree search per MCTS decision
+MCTS_ITERATIONS = 0 # default maximal number of MCTS iterations per decision (0 for no limit)
+MCTS_HORIZON = 4 # default number of swaps each MCTS iteration plays ahead
+MCTS_EXPLORATION = 1.0 # UCB exploration constant, relative to the largest reward seen
+TIME_BUDGET_MS = 0 # default milliseconds a solver may spend per decision (0 for no limit)
+MAX_NODES = 0 # default number of nodes a solver may expand per decision (0 for no limit)
+POOL_TIMEOUT = 7 * 24 * 3600 # seconds to wait for a single game in a worker process
+BATCH_SIZE = 1000 # default number of games the vectorized simulator plays at once
+METRICS_INTERVAL = 10 # default seconds between rewrites of the metrics file
+FLUSH_GAMES = 100 # default number of games between flushes of the result files
+FLUSH_SECONDS = 5 # default maximal seconds between flushes of the result files
+
+# The columns of the CSV log, with the format of each value.
+LOG_COLUMNS = (('board_size', '%d'), ('gem_number', '%d'),
+               ('w_score', '%.2f'), ('w_pairs', '%.2f'),
+               ('w_nmoves', '%.2f'), ('w_depth', '%.2f'), ('w_touching', '%.2f'),
+               ('avg_h_score', '%.2f'), ('avg_h_pairs', '%.2f'),
+               ('avg_h_nmoves', '%.2f'), ('avg_h_depth', '%.2f'), ('avg_h_touching', '%.2f'),
+               ('goal_score', '%d'), ('swaps', '%d'), ('score', '%d'), ('status', '%s'),
+               ('algorithm', '%s'), ('algo_heuristic', '%s'), ('time_seconds', '%.2f'),
+               ('decisions', '%d'), ('avg_decision_ms', '%.2f'), ('max_decision_ms', '%.2f'),
+               ('nodes_expanded', '%d'), ('avg_branching', '%.2f'), ('candidate_moves', '%d'),
+               ('legal_moves', '%d'), ('max_fringe', '%d'), ('max_visited', '%d'), ('cache_hits', '%d'),
+               ('budget_hits', '%d'), ('board_height', '%d'))
+
+# The columns of the binary log, with their struct codes. These are the
+# numeric CSV columns, with 'status' stored as win (1 or 0) and
+# 'algorithm' as its -a number.
+BINARY_LOG_COLUMNS = (('board_size', 'H'), ('gem_number', 'B'),
+                      ('w_score', 'f'), ('w_pairs', 'f'), ('w_nmoves', 'f'), ('w_depth', 'f'), ('w_touching', 'f'),
+                      ('avg_h_score', 'f'), ('avg_h_pairs', 'f'), ('avg_h_nmoves', 'f'), ('avg_h_depth', 'f'),
+                      ('avg_h_touching', 'f'),
+                      ('goal_score', 'i'), ('swaps', 'i'), ('score', 'i'), ('win', 'B'), ('algorithm', 'B'),
+                      ('time_seconds', 'f'),
+                      ('decisions', 'i'), ('avg_decision_ms', 'f'), ('max_decision_ms', 'f'),
+                      ('nodes_expanded', 'q'), ('avg_branching', 'f'), ('candidate_moves', 'q'),
+                      ('legal_moves', 'q'), ('max_fringe', 'i'), ('max_visited', 'i'), ('cache_hits', 'q'),
+                      ('budget_hits', 'i'), ('board_height', 'H'))
+BINARY_LOG_STRUCT = struct.Struct('<' + ''.join([code for name, code in BINARY_LOG_COLUMNS]))
+BINARY_LOG_MAGIC = 'GEMLOG1\n'
+
+# Game trace files start with TRACE_MAGIC, followed by one frame per game:
+# a TRACE_FRAME header, the packed initial board and moves, and TRACE_END.
+TRACE_MAGIC = 'GEMTRC1\n'
+TRACE_FRAME = struct.Struct('<4sqIBBBBIII') # 'GAME', base seed, game, width, height, gems,
+                                            # algorithm, goal score, score, payload size
+TRACE_END = '\xfeGAMEND\xfe'
+
 J = False
 
+# Zobrist keys of boards (see Board.zobrist()): ZOBRIST[i * 8 + gem] is the
+# random key of gem in the space at flat index i. Gems are indexed by
+# their low 3 bits, so EMPTY_SPACE (-1) falls on entry 7, which is 0.
+# The keys fit a C long, so they can be kept in array('l').
+ZOBRISTBITS = 8 * array('l').itemsize - 1
+ZOBRIST = []
+ZOBRIST_RANDOM = random.Random(0) # fixed, so keys match across runs
+
+# pygame is only imported (by initGraphics) when graphics are on, so
+# headless runs never load it. These globals are set up there as well.
+pygame = FPSCLOCK = DISPLAYSURF = GEMIMAGES = BASICFONT = BOARDRECTS = None
+
+# Renderer state, also set up by initGraphics(). Only what changed is
+# redrawn: BACKGROUND is the empty window with the grid, SCREENCELLS is
+# the gem drawn in each space (None if it must be redrawn), SCREENTEXTS
+# maps a text slot to the (text, rect) drawn in it (text is None if it
+# must be redrawn), OVERLAYS are the rects drawn over the board in the
+# last frame (moving gems, highlights, points), and DIRTYRECTS are the
+# rects to pass to display.update().
+BACKGROUND = SCREENCELLS = None
+SCREENTEXTS = {}
+TEXTSURFACES = {}
+OVERLAYS = []
+DIRTYRECTS = []
+
+class Board(object):
+    # A compact board data structure. The gems are kept column by column
+    # in one flat array('b'), so space (x, y) lives at index x * height + y
+    # and each column is a contiguous slice (which suits gravity).
+    # Copies share the underlying array until one of them is written to,
+    # and the keys used for hashing are cached until the next write.
+    # Spaces are read and written as board[x, y].
+
+    __slots__ = ('width', 'height', 'cells', '_shared', '_key', '_zobrist', '_canonical')
+
+    def __init__(self, width, height, cells=None):
+        self.width = width
+        self.height = height
+        if cells is None:
+            cells = array('b', [EMPTY_SPACE]) * (width * height)
+        self.cells = cells
+        self._shared = False
+        self._key = None
+        self._zobrist = None
+        self._canonical = None
+
+    def copy(self):
+        # Cheap copy-on-write clone: no gems are copied until a write.
+        clone = Board(self.width, self.height, self.cells)
+        clone._key = self._key
+        clone._zobrist = self._zobrist
+        clone._canonical = self._canonical
+        clone._shared = self._shared = True
+        return clone
+
+    def writable(self):
+        # Returns the flat cell array, ready to be written to.
+        if self._shared:
+            self.cells = self.cells[:]
+            self._shared = False
+        self._key = self._zobrist = self._canonical = None
+        return self.cells
+
+    def index(self, x, y):
+        return x * self.height + y
+
+    def __getitem__(self, pos):
+        return self.cells[pos[0] * self.height + pos[1]]
+
+    def __setitem__(self, pos, gem):
+        self.writable()[pos[0] * self.height + pos[1]] = gem
+
+    def column(self, x):
+        return self.cells[x * self.height:(x + 1) * self.height].tolist()
+
+    def setColumn(self, x, gems):
+        self.writable()[x * self.height:(x + 1) * self.height] = array('b', gems)
+
+    def key(self):
+        # A compact, hashable snapshot of the board's contents.
+        if self._key is None:
+            self._key = self.cells.tostring()
+        return self._key
+
+    def zobrist(self):
+        # A ZOBRISTBITS-bit key of the board's contents: the XOR of the
+        # keys of its gems (0 for the blank board). Only a few of the
+        # boards the solvers make are ever looked up, so it is computed
+        # when asked for rather than kept up to date on every write.
+        if self._zobrist is None:
+            cells = self.cells
+            if len(ZOBRIST) < 8 * len(cells):
+                extendZobristTable(len(cells))
+            zobrist = 0
+            for index in range(len(cells)):
+                zobrist ^= ZOBRIST[index * 8 + (cells[index] & 7)]
+            self._zobrist = zobrist
+        return self._zobrist
+
+    def canonical(self):
+        # The board's normal form under the game's symmetries: gravity is
+        # vertical, so the board's left-to-right mirror is an equivalent
+        # position, and so is any relabelling of its gem colors. Of the
+        # board and its mirror, the one whose key is smallest once its
+        # colors are numbered by first appearance is the normal form.
+        # Returns (board, mirrored, table, restore): the normal form,
+        # whether it is mirrored, and the translate tables that relabel
+        # this board's colors to it and back (None if they are the same),
+        # so transformBoard(self, mirrored, table) is the normal form.
+        if self._canonical is None:
+            height = self.height
+            data = self.key()
+            mirror = ''.join([data[x * height:(x + 1) * height] for x in range(self.width - 1, -1, -1)])
+            best = None
+            for mirrored, cells in ((False, data), (True, mirror)):
+                table, restore = getColorTables(cells)
+                key = cells.translate(table) if table is not None else cells
+                if best is None or key < best[0]:
+                    best = (key, mirrored, table, restore)
+            key, mirrored, table, restore = best
+            board = Board(self.width, height, array('b', key))
+            board._key = key
+            board._canonical = (board, False, None, None)
+            self._canonical = (board, mirrored, table, restore)
+        return self._canonical
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __eq__(self, other):
+        return isinstance(other, Board) and self.width == other.width and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+def extendZobristTable(ncells):
+    # Adds random keys to ZOBRIST for spaces up to flat index ncells - 1.
+    while len(ZOBRIST) < 8 * ncells:
+        ZOBRIST.extend([int(ZOBRIST_RANDOM.getrandbits(ZOBRISTBITS)) for gem in range(7)] + [0])
+
+def getColorTables(data):
+    # Returns translate tables that number the gems of a board key by
+    # their first appearance, and back, or (None, None) if they already
+    # are numbered so.
+    gems = set(data)
+    gems.discard(EMPTY_CHAR)
+    order = []
+    for gem in data:
+        if gem != EMPTY_CHAR and gem not in order:
+            order.append(gem)
+            if len(order) == len(gems):
+                break
+    source = ''.join(order)
+    labels = ''.join([chr(label) for label in range(len(order))])
+    if source == labels:
+        return None, None
+    return string.maketrans(source, labels), string.maketrans(labels, source)
+
+def transformBoard(board, mirrored, table):
+    # Returns a copy of board, mirrored left-to-right if mirrored, and
+    # with its gems relabelled by the translate table (if not None).
+    if not mirrored and table is None:
+        return board.copy()
+    height = board.height
+    data = board.key()
+    if mirrored:
+        data = ''.join([data[x * height:(x + 1) * height] for x in range(board.width - 1, -1, -1)])
+    if table is not None:
+        data = data.translate(table)
+    transformed = Board(board.width, height, array('b', data))
+    transformed._key = data
+    return transformed
+
+def mirrorSwap(x, direction, width):
+    # Returns the (x, direction) of the mirror image of a RIGHT or DOWN
+    # swap from column x, on a board mirrored left-to-right.
+    if direction == RIGHT:
+        return width - 2 - x, RIGHT
+    return width - 1 - x, direction
+
+class KeySet(object):
+    # A set of nonzero Zobrist keys, in an open-addressing hash table kept
+    # in one array('l'): about 16 bytes per key, against about 60 for a
+    # set of Python ints, or 100 for a set of Board.key() strings.
+    # 0 marks a free slot, so the blank board's key is kept aside.
+
+    __slots__ = ('slots', 'mask', 'count', 'has_zero')
+
+    def __init__(self, capacity=1024):
+        size = 16
+        while size < 2 * capacity:
+            size *= 2
+        self.slots = array('l', [0]) * size
+        self.mask = size - 1
+        self.count = 0
+        self.has_zero = False
+
+    def add(self, key):
+        # Adds key, and returns False if it was already in the set.
+        if not key:
+            if self.has_zero:
+                return False
+            self.has_zero = True
+            self.count += 1
+            return True
+        slots = self.slots
+        index = key & self.mask
+        while slots[index]:
+            if slots[index] == key:
+                return False
+            index = (index + 1) & self.mask # linear probing
+        slots[index] = key
+        self.count += 1
+        if 2 * self.count > len(slots):
+            self.grow()
+        return True
+
+    def __contains__(self, key):
+        if not key:
+            return self.has_zero
+        slots = self.slots
+        index = key & self.mask
+        while slots[index]:
+            if slots[index] == key:
+                return True
+            index = (index + 1) & self.mask
+        return False
+
+    def grow(self):
+        old = self.slots
+        self.slots = array('l', [0]) * (2 * len(old))
+        self.mask = len(self.slots) - 1
+        for key in old:
+            if key:
+                index = key & self.mask
+                while self.slots[index]:
+                    index = (index + 1) & self.mask
+                self.slots[index] = key
+
+    def __len__(self):
+        return self.count
+
+class RunningStats(object):
+    # Count, mean, variance, min and max of a stream of values, kept in
+    # constant memory (Welford's algorithm).
+
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squared distances from the mean
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / float(self.count)
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        # Adds all the values counted by other (Chan et al.'s update).
+        if not other.count:
+            return
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / float(count)
+        self.m2 += other.m2 + delta * delta * self.count * other.count / float(count)
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def getVariance(self):
+        return self.m2 / self.count if self.count else 0
+
+    def getStd(self):
+        return math.sqrt(self.getVariance())
+
+    def getSampleStd(self):
+        # The standard deviation estimated from the values as a sample
+        # (divided by count - 1).
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0
+
+
+class MoveCache(object):
+    # A bounded transposition table for simulated moves. It maps
+    # (source board key, x, y, direction, cascade) to a MoveCacheEntry,
+    # and evicts the least recently used entries once the estimated
+    # memory use goes over max_bytes.
+    # Only deterministic (random_fall=False) simulations may be cached.
+
+    # An optional SharedMoveCache backs it: misses are looked up there, and
+    # new entries are written through to it.
+
+    # With canonical set, source boards are keyed by their normal form
+    # (see Board.canonical()), so a board's mirror and its relabellings
+    # share entries, at the cost of normalizing every source board.
+
+    def __init__(self, max_bytes, shared=None, canonical=False):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.canonical = canonical
+        self.entries = OrderedDict()
+        self.entry_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.store(key, entry) # as the most recently used
+        return entry
+
+    def put(self, key, entry):
+        if self.shared is not None:
+            self.shared.put(key, entry)
+        self.store(key, entry)
+
+    def store(self, key, entry):
+        if not self.max_bytes:
+            return # only backed by the shared cache
+        if not self.entry_bytes:
+            # Rough per-entry footprint: the key and the board bytes,
+            # plus the dict slot, tuple, Board, array and entry objects.
+            self.entry_bytes = 2 * len(key[0]) + 400
+        self.entries[key] = entry
+        while self.entries and len(self.entries) * self.entry_bytes > self.max_bytes:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def putFeatures(self, key, features):
+        # Called when the 'board' features of a cached entry are computed
+        # (the entry itself is updated in place).
+        if self.shared is not None:
+            self.shared.putFeatures(key, features)
+
+    def flush(self):
+        if self.shared is not None:
+            self.shared.flush()
+
+    def getHitRate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SharedMoveCache(object):
+    # A persistent move cache in a memory-mapped file: a fixed-size hash
+    # table that worker processes and later runs share. It maps the same
+    # (board key, x, y, direction, cascade) keys as MoveCache, plus the
+    # board's width and height, to the destination board, the score and
+    # the board features of the move.
+    #
+    # A slot holds the MD5 tag of its key (all zeros if empty), a sequence
+    # number, then the score, the features (UNKNOWN until they are first
+    # computed), and the destination board. Keys are placed by
+    # linear probing within PROBES slots of their tag's home slot; when
+    # those are all taken, the home slot is overwritten, so the file never
+    # grows. Readers take no lock. A writer takes an exclusive lock on the
+    # file, makes the slot's sequence number odd, writes the tag and the
+    # value, and makes it even again; a reader only trusts a value whose
+    # sequence number is even and the same before and after reading it,
+    # and whose tag is still its key's, so a torn or interrupted write
+    # reads as a miss.
+    #
+    # New entries and features are kept in memory until flush(), which
+    # writes them all under a single lock (the solver flushes after every
+    # decision).
+    #
+    # The file is created with room for boards of up to max_cells spaces;
+    # an existing file keeps its own size and capacity.
+
+    MAGIC = 'GEMMCC2\n'
+    HEADER = struct.Struct('<8sIIQ') # magic, slots, max_cells, entries
+    HEADER_SIZE = 64
+    SEQ = struct.Struct('<I') # odd while the slot is being written
+    VALUE = struct.Struct('<hHHH') # score, pairs, nmoves, touching
+    VALUE_START = 16 + SEQ.size
+    EMPTY_TAG = '\0' * 16
+    UNKNOWN = 0xffff
+    PROBES = 8
+
+    def __init__(self, path, max_bytes=SHARED_CACHE_MB * 1024 * 1024, width=None, height=None,
+                 max_cells=SHARED_CACHE_CELLS):
+        self.path = path
+        self.width = width if width is not None else BOARDWIDTH
+        self.height = height if height is not None else BOARDHEIGHT
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pending = {} # tag -> value of the entries not written yet
+        self.pending_features = {} # tag -> features not written yet
+        self.last_tag = (None, None)
+
+        self.file_obj = open(path, 'a+b')
+        self.lock()
+        try:
+            self.file_obj.seek(0, os.SEEK_END)
+            if self.file_obj.tell() == 0:
+                slot_size = self.VALUE_START + self.VALUE.size + max_cells
+                slots = max(self.PROBES, (max_bytes - self.HEADER_SIZE) // slot_size)
+                self.file_obj.write(self.HEADER.pack(self.MAGIC, slots, max_cells, 0).ljust(self.HEADER_SIZE, '\0'))
+                self.file_obj.truncate(self.HEADER_SIZE + slots * slot_size)
+                self.file_obj.flush()
+        finally:
+            self.unlock()
+        self.map = mmap.mmap(self.file_obj.fileno(), 0)
+        magic, self.slots, self.max_cells, entries = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise ValueError("%s is not a shared move cache file of this version" %path)
+        self.slot_size = self.VALUE_START + self.VALUE.size + self.max_cells
+        self.cells = self.width * self.height
+
+    def lock(self):
+        if fcntl is not None:
+            fcntl.flock(self.file_obj.fileno(), fcntl.LOCK_EX)
+
+    def unlock(self):
+        if fcntl is not None:
+            fcntl.flock(self.file_obj.fileno(), fcntl.LOCK_UN)
+
+    def getTag(self, key):
+        # The last key's tag is kept, as a miss is followed by a put.
+        if self.last_tag[0] != key:
+            board_key, x, y, direction, cascade = key
+            self.last_tag = (key, hashlib.md5('%d,%d,%d,%d,%s,%d|' %(self.width, self.height, x, y, direction,
+                                                                    cascade) + board_key).digest())
+        return self.last_tag[1]
+
+    def getOffsets(self, tag):
+        home = struct.unpack_from('<Q', tag)[0] % self.slots
+        for i in range(self.PROBES):
+            yield self.HEADER_SIZE + ((home + i) % self.slots) * self.slot_size
+
+    def get(self, key):
+        # Returns a MoveCacheEntry, or None.
+        if self.cells > self.max_cells:
+            return None
+        tag = self.getTag(key)
+        value = self.pending.get(tag)
+        if value is not None:
+            self.hits += 1
+            return self.getEntry(value, self.pending_features.get(tag))
+        for offset in self.getOffsets(tag):
+            slot_tag = self.map[offset:offset + 16]
+            if slot_tag == self.EMPTY_TAG:
+                break
+            if slot_tag != tag:
+                continue
+            seq = self.SEQ.unpack_from(self.map, offset + 16)[0]
+            value = self.map[offset + self.VALUE_START:offset + self.VALUE_START + self.VALUE.size + self.cells]
+            if seq & 1 or self.SEQ.unpack_from(self.map, offset + 16)[0] != seq or \
+                    self.map[offset:offset + 16] != tag:
+                break # being written, or overwritten while reading
+            self.hits += 1
+            return self.getEntry(value, self.pending_features.get(tag))
+        self.misses += 1
+        return None
+
+    def getEntry(self, value, features=None):
+        score, pairs, nmoves, touching = self.VALUE.unpack_from(value)
+        entry = MoveCacheEntry(Board(self.width, self.height, array('b', value[self.VALUE.size:])), score)
+        if features is not None:
+            entry.features['board'] = features
+        elif pairs != self.UNKNOWN:
+            entry.features['board'] = (pairs, nmoves, touching)
+        return entry
+
+    def put(self, key, entry):
+        if self.cells > self.max_cells:
+            return
+        pairs, nmoves, touching = entry.features.get('board', (self.UNKNOWN,) * 3)
+        self.pending[self.getTag(key)] = self.VALUE.pack(entry.score, pairs, nmoves, touching) + entry.dest_board.key()
+
+    def putFeatures(self, key, features):
+        if self.cells > self.max_cells:
+            return
+        self.pending_features[self.getTag(key)] = features
+
+    def flush(self):
+        # Writes the pending entries and features to the file.
+        if not self.pending and not self.pending_features:
+            return
+        self.lock()
+        try:
+            added = 0
+            for tag, value in self.pending.iteritems():
+                features = self.pending_features.pop(tag, None)
+                if features is not None:
+                    value = value[:2] + struct.pack('<HHH', *features) + value[self.VALUE.size:]
+                target = None
+                for offset in self.getOffsets(tag):
+                    slot_tag = self.map[offset:offset + 16]
+                    if slot_tag == tag:
+                        # Another process got here first.
+                        if features is not None:
+                            self.writeSlot(offset, tag, struct.pack('<HHH', *features), 2)
+                        break
+                    if slot_tag == self.EMPTY_TAG:
+                        target = offset
+                        added += 1
+                        break
+                else:
+                    target = next(self.getOffsets(tag))
+                    self.evictions += 1
+                if target is not None:
+                    self.writeSlot(target, tag, value)
+            for tag, features in self.pending_features.iteritems():
+                for offset in self.getOffsets(tag):
+                    slot_tag = self.map[offset:offset + 16]
+                    if slot_tag == self.EMPTY_TAG:
+                        break
+                    if slot_tag == tag:
+                        self.writeSlot(offset, tag, struct.pack('<HHH', *features), 2)
+                        break
+            if added:
+                self.setEntries(self.getEntries() + added)
+        finally:
+            self.unlock()
+        self.pending.clear()
+        self.pending_features.clear()
+
+    def writeSlot(self, offset, tag, data, value_offset=0):
+        # Writes the tag, and data at value_offset into the slot's value,
+        # between an odd and an even sequence number.
+        seq = self.SEQ.unpack_from(self.map, offset + 16)[0]
+        self.SEQ.pack_into(self.map, offset + 16, (seq + 1) & 0xffffffff)
+        self.map[offset:offset + 16] = tag
+        start = offset + self.VALUE_START + value_offset
+        self.map[start:start + len(data)] = data
+        self.SEQ.pack_into(self.map, offset + 16, (seq + 2) & 0xffffffff)
+
+    def getEntries(self):
+        return self.HEADER.unpack_from(self.map, 0)[3]
+
+    def setEntries(self, entries):
+        struct.pack_into('<Q', self.map, self.HEADER.size - 8, entries)
+
+    def getHitRate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0
+
+    def close(self):
+        self.flush()
+        self.map.flush()
+        self.map.close()
+        self.file_obj.close()
+
+
+class MoveCacheEntry(object):
+    # The cached result of one simulated move. features holds heuristic
+    # values of dest_board (e.g. 'pairs'), filled in as they are computed.
+
+    __slots__ = ('dest_board', 'score', 'features')
+
+    def __init__(self, dest_board, score):
+        self.dest_board = dest_board
+        self.score = score
+        self.features = {}
+
+
 class BoardMove(object):
 
-    def __init__(self, source_board, x, y, direction, random_fall, cascade):
+    def __init__(self, source_board, x, y, direction, random_fall, cascade, cache=None):
         self.first = self.second = self.dest_board = None
         self.score = 0
         self.random_fall = random_fall
         self.cascade = cascade
-        self.source_board = copy.deepcopy(source_board)
+        self.features = None
+        self.cache_key = None
+        if cache is not None and cache.canonical and not random_fall:
+            source_board.canonical() # worked out once, and shared by the copies
+        self.source_board = source_board.copy()
         self.create_dicts(x, y, direction)
         if self.second is not None:
-            self.perform_move()
+            if cache is not None and not random_fall:
+                self.perform_cached_move(cache)
+            else:
+                self.perform_move()
 
     def create_dicts(self, x, y, direction):
 
@@ -112,12 +771,35 @@ class BoardMove(object):
 
     def perform_move(self):
         if self.cascade:
-            self.dest_board, self.score = perform_move(copy.deepcopy(self.source_board), self.first, self.second,
+            self.dest_board, self.score = perform_move(self.source_board.copy(), self.first, self.second,
                                                        score=0, simulation=True, random_fall=self.random_fall)
         else:
-            self.dest_board, self.score = perform_single_move(copy.deepcopy(self.source_board), self.first, self.second,
+            self.dest_board, self.score = perform_single_move(self.source_board.copy(), self.first, self.second,
                                                               score=0, simulation=True, random_fall=self.random_fall)
 
+    def perform_cached_move(self, cache):
+        # With a canonical cache, the move is looked up as the same move on
+        # the normal form of the source board, whose outcome is kept in the
+        # normal form's frame, and mapped back to this board's. The score
+        # and the features do not change under the mapping.
+        if cache.canonical:
+            canonical, mirrored, table, restore = self.source_board.canonical()
+        else:
+            canonical, mirrored, table, restore = self.source_board, False, None, None
+        x, direction = self.first['x'], self.first['direction']
+        if mirrored:
+            x, direction = mirrorSwap(x, direction, canonical.width)
+        key = self.cache_key = (canonical.key(), x, self.first['y'], direction, self.cascade)
+        entry = cache.get(key)
+        if entry is None:
+            self.perform_move()
+            entry = MoveCacheEntry(transformBoard(self.dest_board, mirrored, table), self.score)
+            cache.put(key, entry)
+        else:
+            self.dest_board = transformBoard(entry.dest_board, mirrored, restore)
+            self.score = entry.score
+        self.features = entry.features
+
     def __str__(self):
         return "MOVE: (x, y): (%d, %d); Direction %s; Score: %d" %(self.first['x'], self.first['y'],
                                                                    self.first['direction'], self.score)
@@ -136,6 +818,7 @@ class FringeState(object):
         self.moves = moves[:]
         self.total_move_num = total_move_num
         self.total_score = total_score
+        self.heuristic = None # set by Solver.getStateHeuristic()
 
     def getMovesScore(self):
         return sum([m.score for m in self.moves])
@@ -158,66 +841,288 @@ class FringeState(object):
         return 0
 
 
+class MCTSNode(object):
+    # A node of the MCTS tree. The tree is open loop: a node stands for a
+    # sequence of swaps from the root, whatever gems fell in between, so
+    # its children are keyed by (x, y, direction) swaps.
+
+    __slots__ = ('children', 'visits', 'total')
+
+    def __init__(self):
+        self.children = {}
+        self.visits = 0
+        self.total = 0.0
+
+    def getMean(self):
+        return self.total / self.visits if self.visits else 0
+
+
 class Solver(object):
 
-    def __init__(self, random_fall, solver_type, weights):
+    def __init__(self, random_fall, solver_type, weights, cache_mb=CACHE_MB,
+                 beam_width=BEAM_WIDTH, beam_depth=BEAM_DEPTH,
+                 mcts_ms=MCTS_MS, mcts_iterations=MCTS_ITERATIONS, mcts_horizon=MCTS_HORIZON,
+                 time_budget_ms=TIME_BUDGET_MS, max_nodes=MAX_NODES,
+                 shared_cache=None, shared_cache_mb=SHARED_CACHE_MB, canonical_keys=False):
         self.random_fall = random_fall
         self.type = solver_type
         self.uncertainty_thres = 0.15
         self.expanded_nodes = 0
+        self.beam_width = beam_width
+        self.beam_depth = beam_depth
+        self.mcts_ms = mcts_ms
+        self.mcts_iterations = mcts_iterations
+        self.mcts_horizon = mcts_horizon
+
+        # Per-decision budget (0 for no limit). getSwaps() sets the
+        # deadline and node limit of the current decision.
+        self.time_budget_ms = time_budget_ms
+        self.max_nodes = max_nodes
+        self.deadline = None
+        self.node_limit = None
+
+        # Move cache, optionally backed by a shared cache file. With random
+        # falls a move's outcome is not a function of the board, so the
+        # caches are bypassed.
+        self.cache = None
+        if (cache_mb > 0 or shared_cache) and not random_fall:
+            shared = None
+            if shared_cache:
+                shared = SharedMoveCache(shared_cache, int(shared_cache_mb * 1024 * 1024),
+                                         max_cells=max(SHARED_CACHE_CELLS, BOARDWIDTH * BOARDHEIGHT))
+            self.cache = MoveCache(int(cache_mb * 1024 * 1024), shared, canonical_keys)
+
+        # Whether L-BFS deduplicates boards (and the move cache keys them)
+        # by their normal form under the game's symmetries.
+        self.canonical_keys = canonical_keys
 
         # Heuristics Weights
+        self.weights = weights
         self.w_score = weights[0]
         self.w_pairs = weights[1]
         self.w_nmoves = weights[2]
         self.w_depth = weights[3]
         self.w_touching = weights[4]
 
-        self.h_score_list = []
-        self.h_pairs_list = []
-        self.h_nmoves_list = []
-        self.h_depth_list = []
-        self.h_touching_list = []
+        # Stats of the weighted heuristic parts, by name: h_stats is for the
+        # current game, and h_total_stats for the games before it.
+        self.h_stats = dict([(name, RunningStats()) for name in HEURISTIC_NAMES])
+        self.h_total_stats = dict([(name, RunningStats()) for name in HEURISTIC_NAMES])
+
+        # Per-decision metrics: 'metrics' is filled in by the current
+        # getSwaps() call, and 'decisions' keeps one dict per decision
+        # of the current game.
+        self.metrics = {}
+        self.decisions = []
+
+        # The (board key, count_moves, features) of the last board whose
+        # moves' features were computed; a move's features are worked out
+        # from those of its source board (see getBoardFeaturesAfter()).
+        self.source_features = (None, None, None)
+
+    def resetStats(self):
+        # Called at the start of each game, so logged stats are per-game.
+        self.expanded_nodes = 0
+        for name in HEURISTIC_NAMES:
+            self.h_total_stats[name].merge(self.h_stats[name])
+            self.h_stats[name] = RunningStats()
+        self.decisions = []
+
+    def getCumulativeStats(self, name):
+        # Stats of a heuristic part over all games, including this one.
+        stats = RunningStats()
+        stats.merge(self.h_total_stats[name])
+        stats.merge(self.h_stats[name])
+        return stats
 
     def getSwaps(self, board, cur_score=0):
 
+        self.metrics = {'nodes': 0, 'candidates': 0, 'legal': 0, 'expansions': 0,
+                        'max_fringe': 0, 'visited': 0, 'budget_hit': 0}
+        start_nodes = self.expanded_nodes
+        start_hits = self.cache.hits if self.cache is not None else 0
+        start = time.time()
+        self.deadline = start + self.time_budget_ms / 1000.0 if self.time_budget_ms else None
+        self.node_limit = start_nodes + self.max_nodes if self.max_nodes else None
+
         if self.type == STUPID_GREEDY:
-            return self.getSwapStupidGreedy(board)
+            swaps = self.getSwapStupidGreedy(board)
 
         elif self.type == SMART_GREEDY:
-            return self.getSwapSmartGreedy(board)
+            swaps = self.getSwapSmartGreedy(board)
 
         elif self.type == LBFS:
-            return self.getSwapsLBFS(board, cur_score)
+            swaps = self.getSwapsLBFS(board, cur_score)
+
+        elif self.type == BEAM:
+            swaps = self.getSwapsBeam(board, cur_score)
+
+        elif self.type == MCTS:
+            swaps = self.getSwapMCTS(board, cur_score)
+
+        if self.cache is not None:
+            self.cache.flush() # so other processes see this decision's moves
+        self.metrics['ms'] = (time.time() - start) * 1000
+        self.metrics['nodes'] = self.expanded_nodes - start_nodes
+        self.metrics['cache_hits'] = (self.cache.hits if self.cache is not None else 0) - start_hits
+        self.decisions.append(self.metrics)
+        return swaps
+
+    def withinBudget(self, pending_nodes=0):
+        # Returns False once the current decision has used up its time or
+        # node budget, and marks the decision as having hit it. Solvers
+        # check it between steps and fall back to the best move found so
+        # far; at least one move is always simulated, so there is always
+        # a move to return.
+        if self.node_limit is not None and self.expanded_nodes + pending_nodes >= self.node_limit:
+            self.metrics['budget_hit'] = 1
+            return False
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.metrics['budget_hit'] = 1
+            return False
+        return True
+
+    def getMovesWithinBudget(self, moves):
+        # Yields the moves one by one while the time budget lasts, and at
+        # least the first one. The moves are already simulated (and
+        # counted), so the node limit does not apply to them.
+        for i, move in enumerate(moves):
+            if i and self.deadline is not None and time.time() >= self.deadline:
+                self.metrics['budget_hit'] = 1
+                return
+            yield move
 
     def getSwapsLBFS(self, start_board, cur_score):
-        fringe = [] # In practice - a queue.
-        visited = set()
+        fringe = deque()
+        visited = KeySet()
         leaves = []
         start_state = FringeState(start_board, total_score=cur_score)
         best = start_state
         fringe.append(start_state)
 
-        while fringe:
+        # With a budget, states are scored as they are generated (while
+        # the budget lasts, and at least one per expansion), and the best
+        # state of each depth is kept, along with the first goal state
+        # (which has the fewest moves), so running out of budget takes no
+        # further feature passes.
+        budgeted = self.node_limit is not None or self.deadline is not None
+        depth_best = {}
+        first_goal = None
+        incomplete_depth = None
 
-            cur = fringe.pop(0)
+        while fringe:
 
-            board_tuple = boardTuple(cur.board)
-            if board_tuple in visited:
+            if visited and not self.withinBudget():
+                # Out of budget: the candidates are the leaves so far, the
+                # first goal state, and the best state of the deepest
+                # depth generated and scored in full.
+                full_depth = fringe[0].total_move_num
+                if incomplete_depth is not None:
+                    full_depth = min(full_depth, incomplete_depth - 1)
+                depths = [depth for depth in depth_best if depth <= full_depth] or list(depth_best)
+                if depths:
+                    leaves.append(depth_best[max(depths)])
+                if first_goal is not None:
+                    leaves.append(first_goal)
+                break
+
+            cur = fringe.popleft()
+
+            # With canonical keys, boards are deduplicated by their normal
+            # form: a board's mirror, or a relabelling of its colors,
+            # plays the same.
+            board = cur.board.canonical()[0] if self.canonical_keys else cur.board
+            if not visited.add(board.zobrist()):
                 continue
-            visited.add(board_tuple)
 
+            budget_hit = self.metrics['budget_hit']
             possible_moves = self.getPossibleMoves(cur.board, True)
             is_uncertain = self.isUncertain(cur)
             if not possible_moves or is_uncertain:
                 leaves.append(cur)
                 continue
 
+            scored = False
             for move in possible_moves:
-                fringe.append(FringeState(move.dest_board, cur.moves + [move],
-                                          cur.total_move_num + 1,
-                                          cur.total_score + move.score))
+                state = FringeState(move.dest_board, cur.moves + [move],
+                                    cur.total_move_num + 1,
+                                    cur.total_score + move.score)
+                fringe.append(state)
                 self.expanded_nodes += 1
+                if budgeted and (not scored or self.withinBudget()):
+                    scored = True
+                    depth = state.total_move_num
+                    if depth not in depth_best or \
+                            self.getStateHeuristic(state) > self.getStateHeuristic(depth_best[depth]):
+                        depth_best[depth] = state
+                    if first_goal is None and self.isGoal(state):
+                        first_goal = state
+            if self.metrics['budget_hit'] and not budget_hit:
+                # This expansion, or the scoring of its states, was cut short.
+                incomplete_depth = cur.total_move_num + 1
+            self.metrics['max_fringe'] = max(self.metrics['max_fringe'], len(fringe))
+
+        self.metrics['visited'] = len(visited)
+
+        # Find goal
+        goal_states = [state for state in leaves if self.isGoal(state)]
+        if goal_states:
+            best = min(goal_states, key=lambda g:len(g.moves))
+        else:
+            # Find move that brings us closest to goal
+            best = max(leaves, key=lambda fs: self.getStateHeuristic(fs))
+
+        if SEND_MULTIPLE:
+            return best.moves
+        else:
+            return best.moves[0:1]
+
+    def getSwapsBeam(self, start_board, cur_score):
+        # Like L-BFS, but only the beam_width best states (by
+        # getStateHeuristic) of each depth are expanded, for at most
+        # beam_depth moves, so memory and time per decision are bounded.
+        beam = [FringeState(start_board, total_score=cur_score)]
+        visited = KeySet()
+        visited.add(start_board.zobrist())
+        leaves = []
+
+        for depth in range(self.beam_depth):
+            candidates = []
+            for cur in beam:
+                if depth and not self.withinBudget():
+                    # Out of budget: keep the last fully evaluated beam.
+                    candidates = None
+                    break
+                possible_moves = self.getPossibleMoves(cur.board, True)
+                if not possible_moves or self.isUncertain(cur):
+                    leaves.append(cur)
+                    continue
+
+                for move in possible_moves:
+                    if not visited.add(move.dest_board.zobrist()):
+                        continue
+                    candidates.append(FringeState(move.dest_board, cur.moves + [move],
+                                                  cur.total_move_num + 1,
+                                                  cur.total_score + move.score))
+                    self.expanded_nodes += 1
+
+            if candidates is None:
+                break
+            self.metrics['max_fringe'] = max(self.metrics['max_fringe'], len(candidates))
+            if not candidates:
+                beam = []
+                break
+
+            candidates.sort(key=lambda fs: self.getStateHeuristic(fs), reverse=True)
+            beam = candidates[:self.beam_width]
+
+            if [state for state in beam if self.isGoal(state)]:
+                break
+
+        self.metrics['visited'] = len(visited)
+        leaves = [state for state in leaves + beam if state.moves]
+        if not leaves:
+            return []
 
         # Find goal
         goal_states = [state for state in leaves if self.isGoal(state)]
@@ -232,6 +1137,92 @@ class Solver(object):
         else:
             return best.moves[0:1]
 
+    def getSwapMCTS(self, start_board, cur_score):
+        # Monte-Carlo tree search that, unlike the other solvers, plans
+        # with random refills. Each iteration plays up to mcts_horizon
+        # swaps from the start board: down the tree by UCB while every
+        # legal swap of a node has been tried, then one new node, then
+        # random legal swaps. New gems are drawn at random, so every
+        # iteration sees a different future. Iterations run until the
+        # time or iteration budget is spent, and the most visited first
+        # swap is returned.
+        root_swaps = getLegalSwaps(start_board)
+        self.metrics['candidates'] = getSwapSlotNumber(start_board)
+        self.metrics['legal'] = len(root_swaps)
+        if not root_swaps:
+            return []
+
+        # Rollouts draw from their own generator, seeded from the game's,
+        # so the game's own refills do not depend on the iteration count.
+        rng = random.Random(random.getrandbits(32))
+        remaining = max(GOAL_SCORE - cur_score, 1)
+        root = MCTSNode()
+        max_reward = [1e-9]
+        deadline = time.time() + self.mcts_ms / 1000.0 if self.mcts_ms else None
+        iterations = 0
+        while True:
+            if self.mcts_iterations and iterations >= self.mcts_iterations:
+                break
+            if deadline is not None and iterations and time.time() >= deadline:
+                break
+            if iterations and not self.withinBudget():
+                break
+            self.runMCTSIteration(root, start_board, remaining, rng, max_reward)
+            iterations += 1
+
+        self.metrics['expansions'] = iterations
+        self.metrics['visited'] = len(root.children)
+        x, y, direction = max(root.children, key=lambda swap: (root.children[swap].visits,
+                                                               root.children[swap].getMean()))
+        return [BoardMove(start_board, x, y, direction, False, True, self.cache)]
+
+    def runMCTSIteration(self, root, start_board, remaining, rng, max_reward):
+        board = start_board.copy()
+        path = [root]
+        node = root
+        gained = depth = 0
+        dead_end = False
+        in_tree = True
+        while depth < self.mcts_horizon and gained < remaining:
+            swaps = getLegalSwaps(board)
+            if not swaps:
+                dead_end = True
+                break
+            if in_tree:
+                untried = [swap for swap in swaps if swap not in node.children]
+                if untried:
+                    swap = rng.choice(untried)
+                    node.children[swap] = MCTSNode()
+                    self.expanded_nodes += 1
+                    in_tree = False
+                else:
+                    swap = max(swaps, key=lambda s: self.getUCB(node, node.children[s], max_reward[0]))
+                node = node.children[swap]
+                path.append(node)
+            else:
+                swap = rng.choice(swaps)
+            gained += simulateRandomSwap(board, swap, rng)
+            depth += 1
+
+        reward = self.getMCTSReward(gained, depth, remaining, dead_end)
+        max_reward[0] = max(max_reward[0], reward)
+        for node in path:
+            node.visits += 1
+            node.total += reward
+
+    def getUCB(self, parent, child, scale):
+        return child.getMean() + MCTS_EXPLORATION * scale * math.sqrt(math.log(parent.visits) / child.visits)
+
+    def getMCTSReward(self, gained, depth, remaining, dead_end):
+        # Points gained, where reaching the goal in fewer swaps is worth
+        # more (the swaps left in the horizon are credited at the same
+        # rate), and running out of swaps first - losing - is worth 0.
+        if gained >= remaining:
+            return gained + (self.mcts_horizon - depth) * gained / float(depth)
+        if dead_end:
+            return 0
+        return gained
+
     def isGoal(self, fringe_state):
         return fringe_state.total_score >= GOAL_SCORE
 
@@ -242,21 +1233,26 @@ class Solver(object):
         return False
 
     def getPossibleMoves(self, board, cascade):
+        # Only the swaps that make a match are simulated.
         moves = []
-        for y in range(BOARDHEIGHT):
-            for x in range(BOARDWIDTH):
-                move_right = BoardMove(copy.deepcopy(board), x, y, RIGHT, self.random_fall, cascade)
-                move_down = BoardMove(copy.deepcopy(board), x, y, DOWN, self.random_fall, cascade)
-                for move in (move_right, move_down):
-                    if move.score > 0:
-                        moves.append(move)
+        swaps = getLegalSwaps(board)
+        self.metrics['candidates'] = self.metrics.get('candidates', 0) + getSwapSlotNumber(board)
+        self.metrics['legal'] = self.metrics.get('legal', 0) + len(swaps)
+        self.metrics['expansions'] = self.metrics.get('expansions', 0) + 1
+        for x, y, direction in swaps:
+            if moves and not self.withinBudget(len(moves)):
+                break
+            move = BoardMove(board, x, y, direction, self.random_fall, cascade, self.cache)
+            if move.score > 0:
+                moves.append(move)
         return moves
 
     def getSwapStupidGreedy(self, board):
         moves = self.getPossibleMoves(board, cascade=False)
+        self.expanded_nodes += len(moves)
         if moves:
             random.shuffle(moves)
-            best = max(moves)
+            best = max(moves) # the scores are known, so all the moves are compared
             # print
             # print "MOVES:"
             # for move in moves:
@@ -272,10 +1268,11 @@ class Solver(object):
     def getSwapSmartGreedy(self, board):
 
         moves = self.getPossibleMoves(board, cascade=True)
+        self.expanded_nodes += len(moves)
 
         if moves:
             random.shuffle(moves)
-            best = max(moves, key=lambda m: self.getMoveHeuristic(m))
+            best = max(self.getMovesWithinBudget(moves), key=lambda m: self.getMoveHeuristic(m))
 
             # print "MOVES:"
             # for move in moves:
@@ -290,58 +1287,55 @@ class Solver(object):
 
     def getMoveHeuristic(self, move):
 
-        dest_board = move.dest_board
-
-        h_score = self.w_score * move.score if self.w_score else 0
-        h_pairs = self.w_pairs * self.getPairs(dest_board) if self.w_pairs else 0
-        h_nmoves = self.w_nmoves * self.getMoveNumber(dest_board) if self.w_nmoves else 0
-        h_depth = self.w_depth * self.getDepthFactor(move) if self.w_depth else 0
-        h_touching = self.w_touching * self.getTouchingGemsNum(dest_board) if self.w_touching else 0
-
-        self.h_score_list.append(h_score)
-        self.h_pairs_list.append(h_pairs)
-        self.h_nmoves_list.append(h_nmoves)
-        self.h_depth_list.append(h_depth)
-        self.h_touching_list.append(h_touching)
-
-        res = h_score + h_pairs + h_nmoves + h_depth + h_touching
-
-        return res
-
+        pairs, nmoves, touching = self.getMoveFeatures(move)
+        depth = self.getDepthFactor(move) if self.w_depth else 0
+        return self.applyWeights((move.score, pairs, nmoves, depth, touching))
 
     def getStateHeuristic(self, fs):
-
-        if not fs.moves:
-            return 0
-
-        dest_board = fs.moves[-1].dest_board
-
-        h_score = self.w_score * fs.getMovesFactor() if self.w_score else 0
-        h_pairs = self.w_pairs * self.getPairs(dest_board) if self.w_pairs else 0
-        h_nmoves = self.w_nmoves * self.getMoveNumber(dest_board) if self.w_nmoves else 0
-        h_depth = self.w_depth * self.getStateDepthFactor(fs) if self.w_depth else 0
-        h_touching = self.w_touching * self.getTouchingGemsNum(dest_board) if self.w_touching else 0
-
-        self.h_score_list.append(h_score)
-        self.h_pairs_list.append(h_pairs)
-        self.h_nmoves_list.append(h_nmoves)
-        self.h_depth_list.append(h_depth)
-        self.h_touching_list.append(h_touching)
+        # Worked out once per state, so sorting and picking states does
+        # not recount their features, nor add them to h_stats again.
+        if fs.heuristic is None:
+            if not fs.moves:
+                fs.heuristic = 0
+            else:
+                pairs, nmoves, touching = self.getMoveFeatures(fs.moves[-1])
+                depth = self.getStateDepthFactor(fs) if self.w_depth else 0
+                fs.heuristic = self.applyWeights((fs.getMovesFactor(), pairs, nmoves, depth, touching))
+        return fs.heuristic
+
+    def applyWeights(self, features):
+        # features is the vector (score, pairs, nmoves, depth, touching).
+        h_score, h_pairs, h_nmoves, h_depth, h_touching = \
+            [w * f if w else 0 for w, f in zip(self.weights, features)]
+
+        h_stats = self.h_stats
+        h_stats['score'].add(h_score)
+        h_stats['pairs'].add(h_pairs)
+        h_stats['nmoves'].add(h_nmoves)
+        h_stats['depth'].add(h_depth)
+        h_stats['touching'].add(h_touching)
 
         res = h_score + h_pairs + h_nmoves + h_depth + h_touching
         return res
 
-    #### Heuristics ####
+    def getMoveFeatures(self, move):
+        # Returns getBoardFeatures(move.dest_board), reusing the value
+        # stored in the move's cache entry if there is one.
+        if move.features is None:
+            return self.getDestFeatures(move, count_moves=bool(self.w_nmoves))
+        if 'board' not in move.features:
+            move.features['board'] = self.getDestFeatures(move, count_moves=True)
+            self.cache.putFeatures(move.cache_key, move.features['board'])
+        return move.features['board']
+
+    def getDestFeatures(self, move, count_moves):
+        key, counted, features = self.source_features
+        if key != move.source_board.key() or counted != count_moves:
+            features = getBoardFeatures(move.source_board, count_moves)
+            self.source_features = (move.source_board.key(), count_moves, features)
+        return getBoardFeaturesAfter(move.source_board, features, move.dest_board, count_moves)
 
-    def getTouchingGemsNum(self, board):
-        perimeter = set()
-        for y in range(BOARDHEIGHT):
-            for x in range(BOARDWIDTH):
-                if getGemAt(board, x, y) == -1:
-                    p = [(a,b) for (a,b) in [(x+1, y), (x, y+1), (x-1, y), (x, y-1)]]
-                    perimeter |= set([(a,b) for (a,b) in p if getGemAt(board, a, b) not in (-1, None)])
-        num_of_touching = len(perimeter)
-        return num_of_touching
+    #### Heuristics ####
 
     def getDepthFactor(self, move):
         line = max((move.first['y']+1, move.second['y']+1))
@@ -351,35 +1345,24 @@ class Solver(object):
         avg = mean([self.getDepthFactor(m) for m in fs.moves])
         return avg
 
-    def getPairs(self, board):
-        num_of_pairs = 0
-        for y in range(BOARDHEIGHT):
-            for x in range(BOARDWIDTH):
-                gem = getGemAt(board, x, y)
-                if gem == -1: continue
-                if gem == getGemAt(board, x + 1, y):
-                    num_of_pairs += 1
-                if gem == getGemAt(board, x, y + 1):
-                    num_of_pairs += 1
-        return num_of_pairs
-
     def getEntropy(self, board):
         counts = [0] * NUMGEMIMAGES
-        for col in board:
-            for gem in col:
-                counts[gem] += 1
+        for gem in board.cells:
+            counts[gem] += 1
         tot = sum(counts)
         probs = [float(c)/tot for c in counts]
         entropy = -sum([p * math.log(p, 2) for p in probs if p > 0])
         # print "Expected entropy: %.3f" %entropy
         return entropy
 
-    def getMoveNumber(self, board):
-        res = len(self.getPossibleMoves(board, False))
-        return res
-
 
-def main(is_manual, random_fall, ngames, algo, weights, no_graphics, logfile):
+def main(is_manual, random_fall, ngames, algo, weights, no_graphics, logfile, cache_mb=CACHE_MB,
+         beam_width=BEAM_WIDTH, beam_depth=BEAM_DEPTH, workers=1, seed=None, vectorized=False,
+         batch_size=BATCH_SIZE, decision_log=None, metrics_file=None, metrics_interval=METRICS_INTERVAL,
+         flush_games=FLUSH_GAMES, flush_seconds=FLUSH_SECONDS, rotate_mb=0, binary_log=None,
+         mcts_ms=MCTS_MS, mcts_iterations=MCTS_ITERATIONS, mcts_horizon=MCTS_HORIZON,
+         time_budget_ms=TIME_BUDGET_MS, max_nodes=MAX_NODES, shared_cache=None, shared_cache_mb=SHARED_CACHE_MB,
+         record=None, canonical_keys=False):
 
     print
     games_str = "%d games" %ngames
@@ -390,11 +1373,177 @@ def main(is_manual, random_fall, ngames, algo, weights, no_graphics, logfile):
     print "Running %s in %s mode" %(games_str, 'manual' if is_manual else 'auto')
     if not is_manual:
         print "Using solver algorithm: %s" %algo
+    if workers > 1:
+        print "Using %d worker processes" %workers
+    if vectorized:
+        print "Using the vectorized simulator, %d games per batch" %batch_size
+    if seed is None:
+        seed = random.randint(0, 2 ** 31)
+    print "Base seed: %d (game i uses seed %d + i)" %(seed, seed)
     print
 
-    global FPSCLOCK, DISPLAYSURF, GEMIMAGES, GAMESOUNDS, BASICFONT, BOARDRECTS
+    if not no_graphics:
+        initGraphics()
+
+    solver_args = (random_fall, algo, weights, cache_mb, beam_width, beam_depth,
+                   mcts_ms, mcts_iterations, mcts_horizon, time_budget_ms, max_nodes,
+                   shared_cache, shared_cache_mb, canonical_keys)
+
+    if ngames == 0:
+        ngames = float('inf')
+    game_counter = 1
+
+    # Results are appended to existing files, through buffered writers.
+    rotate_bytes = int(rotate_mb * 1024 * 1024)
+    writer_args = (flush_games, flush_seconds, rotate_bytes)
+    log_writer = ResultWriter(logfile, getLogHeader(), *writer_args)
+    decision_writer = binary_writer = None
+    if decision_log:
+        decision_writer = ResultWriter(decision_log, '', *writer_args)
+    if binary_log:
+        binary_writer = ResultWriter(binary_log, getBinaryLogHeader(), *writer_args,
+                                     record_size=BINARY_LOG_STRUCT.size)
+    trace_writer = None
+    if record:
+        trace_writer = ResultWriter(record, TRACE_MAGIC, *writer_args, record_end=TRACE_END)
+
+    run_metrics = {'start': time.time(), 'last_write': time.time(), 'games': 0, 'wins': 0,
+                   'moves': 0, 'decisions': 0, 'decision_ms': 0, 'nodes': 0, 'budget_hits': 0}
+
+    times = RunningStats() # of won games
+    game_solver = None
+    if vectorized:
+        results = runVectorizedGames(ngames, seed, batch_size, solver_args)
+    elif workers > 1:
+        results = runGamesInPool(ngames, seed, workers, solver_args, bool(record))
+    else:
+        game_solver = Solver(*solver_args)
+        results = runGamesSerially(ngames, seed, is_manual, game_solver, no_graphics, bool(record))
+
+    try:
+        # Results come in game order, whichever process played them.
+        for game_index, score, moves, seconds, log_record, decisions, trace in results:
+            log_writer.write(formatLogLine(log_record) + '\n')
+            if decision_writer is not None:
+                decision_writer.write(getDecisionLines(game_index, decisions))
+            if binary_writer is not None:
+                binary_writer.write(packBinaryLogRecord(log_record))
+            if trace_writer is not None:
+                trace_writer.write(trace)
+            updateRunMetrics(run_metrics, score, moves, decisions)
+            if metrics_file and time.time() - run_metrics['last_write'] >= metrics_interval:
+                writeMetricsFile(metrics_file, run_metrics)
+            print "Game %d ended: %d points in %d moves" %(game_index, score, moves)
+            print "Game took %.2f seconds" % seconds
+            if score >= GOAL_SCORE:
+                times.add(seconds)
+            print
+            game_counter += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for writer in (log_writer, decision_writer, binary_writer, trace_writer):
+            if writer is not None:
+                writer.close()
+
+    if metrics_file:
+        writeMetricsFile(metrics_file, run_metrics)
+
+    print "Finished %d games." %(game_counter-1)
+    print "Average time per finished game: %.2f seconds" %times.mean
+    if time_budget_ms or max_nodes:
+        print "Solver budget hit in %d of %d decisions" %(run_metrics['budget_hits'], run_metrics['decisions'])
+    if game_solver is not None and game_solver.type not in (STUPID_GREEDY, MCTS):
+        print "Average weighted heuristics over all games: " + \
+              ', '.join(['%s %.2f' %(name, game_solver.getCumulativeStats(name).mean) for name in HEURISTIC_NAMES])
+    if game_solver is not None and game_solver.cache is not None:
+        cache = game_solver.cache
+        print "Move cache: %d hits, %d misses (%.1f%% hit rate), %d entries, %d evictions" \
+              %(cache.hits, cache.misses, 100 * cache.getHitRate(), len(cache), cache.evictions)
+    if shared_cache and not random_fall:
+        shared = game_solver.cache.shared if game_solver is not None else SharedMoveCache(shared_cache)
+        if game_solver is not None:
+            print "Shared move cache: %d hits, %d misses (%.1f%% hit rate), %d evictions" \
+                  %(shared.hits, shared.misses, 100 * shared.getHitRate(), shared.evictions)
+        print "Shared move cache %s: %d of %d slots used" %(shared_cache, shared.getEntries(), shared.slots)
+
+def playGame(game_index, seed, is_manual, game_solver, no_graphics, record=False):
+    # Plays game number game_index, seeded with seed + game_index so that
+    # every game can be reproduced on its own. Returns a result tuple of
+    # (game_index, score, moves, seconds, log_record, decisions, trace),
+    # where decisions is the list of the solver's per-decision metrics,
+    # and trace is the packed GameTrace if record is set, or None.
+    random.seed(seed + game_index)
+    game_solver.resetStats()
+    trace = None
+    if record:
+        trace = GameTrace(seed, game_index, BOARDWIDTH, BOARDHEIGHT, NUMGEMIMAGES,
+                          None if is_manual else game_solver.type, GOAL_SCORE)
+    start = datetime.datetime.now()
+    score, moves = runGame(is_manual, game_solver, no_graphics, trace)
+    seconds = (datetime.datetime.now() - start).total_seconds()
+    return (game_index, score, moves, seconds, getLogRecord(score, moves, game_solver, seconds),
+            game_solver.decisions, trace.pack() if record else None)
+
+def runGamesSerially(ngames, seed, is_manual, game_solver, no_graphics, record=False):
+    game_index = 1
+    while game_index <= ngames:
+        print "Game %d started" %game_index
+        yield playGame(game_index, seed, is_manual, game_solver, no_graphics, record)
+        game_index += 1
+
+def initWorker(*solver_args):
+    # Runs once in each worker process. Ctrl-C is left to the main process,
+    # which terminates the pool.
+    global WORKER_SOLVER
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    WORKER_SOLVER = Solver(*solver_args)
+
+def runGameWorker(game_index, seed, record):
+    return playGame(game_index, seed, False, WORKER_SOLVER, True, record)
+
+def runGamesInPool(ngames, seed, workers, solver_args, record=False):
+    # Plays games in a pool of worker processes (headless, auto mode only)
+    # and yields their results in game order. Only a few games per worker
+    # are queued at a time, so this also works when ngames is infinite.
+    pool = multiprocessing.Pool(workers, initWorker, solver_args)
+    pending = deque()
+    next_game = 1
+    try:
+        while pending or next_game <= ngames:
+            while next_game <= ngames and len(pending) < 2 * workers:
+                pending.append(pool.apply_async(runGameWorker, (next_game, seed, record)))
+                next_game += 1
+            # Waiting with a timeout keeps Ctrl-C working in Python 2.
+            yield pending.popleft().get(POOL_TIMEOUT)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def setBoardSize(width, height):
+    # Sets the board's dimensions, and lays out the window for them: the
+    # spaces shrink (from 64 pixels) until the board fits MAXBOARDPIXELS,
+    # and the window grows past 600x600 if the board still does not fit.
+    global BOARDWIDTH, BOARDHEIGHT, GEMIMAGESIZE, WINDOWWIDTH, WINDOWHEIGHT, XMARGIN, YMARGIN
+    BOARDWIDTH = width
+    BOARDHEIGHT = height
+    GEMIMAGESIZE = max(MINGEMIMAGESIZE, min(64, MAXBOARDPIXELS // max(width, height)))
+    WINDOWWIDTH = max(600, GEMIMAGESIZE * width + 2 * WINDOWMARGIN)
+    WINDOWHEIGHT = max(600, GEMIMAGESIZE * height + 2 * WINDOWMARGIN)
+    XMARGIN = int((WINDOWWIDTH - GEMIMAGESIZE * BOARDWIDTH) / 2)
+    YMARGIN = int((WINDOWHEIGHT - GEMIMAGESIZE * BOARDHEIGHT) / 2)
+
+def initGraphics():
+    # Imports pygame, opens the window and loads the fonts and images.
+    # Only called when graphics are on.
+    global pygame, FPSCLOCK, DISPLAYSURF, GEMIMAGES, GAMESOUNDS, BASICFONT, BOARDRECTS
+    global BACKGROUND, SCREENCELLS
 
     # Initial set up.
+    import pygame
     pygame.init()
     FPSCLOCK = pygame.time.Clock()
 
@@ -436,80 +1585,497 @@ def main(is_manual, random_fall, ngames, algo, weights, no_graphics, logfile):
                              GEMIMAGESIZE))
             BOARDRECTS[x].append(r)
 
-    game_solver = Solver(random_fall, algo, weights)
-
-    if ngames == 0:
-        ngames = float('inf')
-    game_counter = 1
-
-    log_header = ','.join(['board_size', 'gem_number',
-                           'w_score', 'w_pairs',
-                           'w_nmoves', 'w_depth', 'w_touching',
-                           'avg_h_score', 'avg_h_pairs',
-                           'avg_h_nmoves', 'avg_h_depth', 'avg_h_touching',
-                           'goal_score', 'swaps', 'score', 'status', 'algorithm', 'algo_heuristic',
-                           'time_seconds'])
-
-    file_obj = open(logfile, 'w')
-    file_obj.write(log_header + '\n')
-    file_obj.close()
-
-    times = []
-    while game_counter <= ngames:
-        try:
-            print "Game %d started" %game_counter
-            start = datetime.datetime.now()
-            score, moves = runGame(is_manual, game_solver, no_graphics)
-            end = datetime.datetime.now()
-            diff = end - start
-            log(logfile, score, moves, game_solver, diff.total_seconds())
-            print "Game %d ended: %d points in %d moves" %(game_counter, score, moves)
-            print "Game took %.2f seconds" % diff.total_seconds()
-            if score >= GOAL_SCORE:
-                times.append(diff.total_seconds())
-            print
-            game_counter += 1
-        except KeyboardInterrupt:
-            break
-
-    print "Finished %d games." %(game_counter-1)
-    print "Average time per finished game: %.2f seconds" %mean(times)
-    file_obj.close()
+    # The empty window with the grid, which the renderer restores parts
+    # of instead of redrawing the whole window every frame.
+    BACKGROUND = pygame.Surface((WINDOWWIDTH, WINDOWHEIGHT))
+    BACKGROUND.fill(BGCOLOR)
+    for x in range(BOARDWIDTH):
+        for y in range(BOARDHEIGHT):
+            pygame.draw.rect(BACKGROUND, GRIDCOLOR, BOARDRECTS[x][y], 1)
+    DISPLAYSURF.blit(BACKGROUND, (0, 0))
+    SCREENCELLS = [None] * (BOARDWIDTH * BOARDHEIGHT)
+    pygame.display.update()
 
 def mean(lst):
     return sum(lst) / float(len(lst)) if lst else 0
 
-def log(logfile, score, moves, solver, seconds):
+def runVectorizedGames(ngames, seed, batch_size, solver_args):
+    # Plays headless SGS games in batches with the NumPy simulator, and
+    # yields their results in game order. A batch of games is seeded with
+    # seed + the index of its first game, and each game's time is its
+    # share of the batch's time.
+    from gemgem_vec import VectorizedGames
+    log_solver = Solver(*solver_args) # only used to fill in the log records
+    game_index = 1
+    while game_index <= ngames:
+        batch = int(min(batch_size, ngames - game_index + 1))
+        start = datetime.datetime.now()
+        games = VectorizedGames(batch, BOARDWIDTH, BOARDHEIGHT, NUMGEMIMAGES, GOAL_SCORE, seed + game_index)
+        scores, moves = games.run()
+        seconds = (datetime.datetime.now() - start).total_seconds() / batch
+        for i in range(batch):
+            score, total_moves = int(scores[i]), int(moves[i])
+            yield (game_index, score, total_moves, seconds, getLogRecord(score, total_moves, log_solver, seconds),
+                   [], None)
+            game_index += 1
+
+def getLogRecord(score, moves, solver, seconds):
+    # Returns the values of a game's CSV log line, in LOG_COLUMNS order.
     status = "win" if score >= GOAL_SCORE else "lose"
     if solver.type == STUPID_GREEDY:
         algo_h = STUPID_GREEDY
     else:
         algo_h = '%s_s%.2f_p%.2f_n%.2f_d%.2f_t%.2f' %(solver.type, solver.w_score, solver.w_pairs, solver.w_nmoves,
                                                       solver.w_depth, solver.w_touching)
+        if solver.type == BEAM:
+            algo_h += '_bw%d_bd%d' %(solver.beam_width, solver.beam_depth)
+    weights = (solver.w_score, solver.w_pairs, solver.w_nmoves, solver.w_depth, solver.w_touching)
+    if solver.type == MCTS:
+        # MCTS uses no heuristic, so it is logged with zero weights.
+        algo_h = '%s_ms%d_it%d_h%d' %(MCTS, solver.mcts_ms, solver.mcts_iterations, solver.mcts_horizon)
+        weights = (0,) * len(weights)
 
-    line = "%d,%d,%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,%d,%d,%d,%s,%s,%s,%.2f" \
-            %(BOARDWIDTH, NUMGEMIMAGES,
+    return ((BOARDWIDTH, NUMGEMIMAGES) + weights +
 
-              solver.w_score, solver.w_pairs,
-              solver.w_nmoves, solver.w_depth, solver.w_touching,
+            (solver.h_stats['score'].mean, solver.h_stats['pairs'].mean,
+             solver.h_stats['nmoves'].mean, solver.h_stats['depth'].mean, solver.h_stats['touching'].mean,
 
-              mean(solver.h_score_list), mean(solver.h_pairs_list),
-              mean(solver.h_nmoves_list), mean(solver.h_depth_list), mean(solver.h_touching_list),
+             GOAL_SCORE, moves, score, status, solver.type, algo_h, seconds)
 
-              GOAL_SCORE, moves, score, status, solver.type, algo_h, seconds)
+            + getDecisionSummary(solver.decisions) + (BOARDHEIGHT,))
 
-    file_obj = open(logfile, 'a')
-    file_obj.write(line + '\n')
-    file_obj.close()
+def getLogHeader():
+    return ','.join([name for name, fmt in LOG_COLUMNS]) + '\n'
+
+def formatLogLine(record):
+    return ','.join([fmt %value for (name, fmt), value in zip(LOG_COLUMNS, record)])
+
+def getLogLine(score, moves, solver, seconds):
+    return formatLogLine(getLogRecord(score, moves, solver, seconds))
 
-def runGame(is_manual=False, game_solver=None, no_graphics=False):
+def getBinaryLogHeader():
+    # A magic line, then a JSON line with the column names and the struct
+    # format of the fixed-size records that follow.
+    columns = {'columns': [name for name, code in BINARY_LOG_COLUMNS], 'format': BINARY_LOG_STRUCT.format}
+    return BINARY_LOG_MAGIC + json.dumps(columns, sort_keys=True) + '\n'
+
+def packBinaryLogRecord(record):
+    values = dict(zip([name for name, fmt in LOG_COLUMNS], record))
+    values['win'] = values['status'] == 'win'
+    values['algorithm'] = [number for number in ALGOS if ALGOS[number] == values['algorithm']][0]
+    return BINARY_LOG_STRUCT.pack(*[values[name] for name, code in BINARY_LOG_COLUMNS])
+
+def readBinaryLog(path):
+    # Yields the records of a binary log file as dicts. With NumPy, the
+    # same file can be loaded in one go with numpy.fromfile(), using the
+    # header's format as the dtype and its length as the offset.
+    file_obj = open(path, 'rb')
+    try:
+        header = getBinaryLogHeader()
+        if file_obj.read(len(header)) != header:
+            raise ValueError("%s is not a binary log of this version" %path)
+        names = [name for name, code in BINARY_LOG_COLUMNS]
+        while True:
+            data = file_obj.read(BINARY_LOG_STRUCT.size)
+            if len(data) < BINARY_LOG_STRUCT.size:
+                break
+            yield dict(zip(names, BINARY_LOG_STRUCT.unpack(data)))
+    finally:
+        file_obj.close()
+
+
+class ResultWriter(object):
+    # Appends per-game results to a file through an in-memory buffer,
+    # which is written out every flush_games games, after flush_seconds
+    # seconds, and on close.
+    #
+    # Each flush appends whole records with a single write, under an
+    # exclusive lock, and syncs the file. Several runs can therefore share
+    # a file, and a crash loses at most the unflushed games; a partial
+    # record left at the end of the file by a crash is dropped on the
+    # next flush. record_size is the size of fixed-size binary records,
+    # or 0 for variable-size records that end with record_end (e.g. text
+    # lines).
+    #
+    # header is written at the start of each new file. An existing file
+    # that starts with a different header (e.g. an older log schema) is
+    # first moved aside. If rotate_bytes is set, a file that grows beyond
+    # it is renamed to <path>.<timestamp>, and the next flush starts a new
+    # one. Renames are atomic, so readers always see complete files.
+
+    def __init__(self, path, header='', flush_games=FLUSH_GAMES, flush_seconds=FLUSH_SECONDS,
+                 rotate_bytes=0, record_size=0, record_end='\n'):
+        self.path = path
+        self.header = header
+        self.flush_games = flush_games
+        self.flush_seconds = flush_seconds
+        self.rotate_bytes = rotate_bytes
+        self.record_size = record_size
+        self.record_end = record_end
+        self.buffer = []
+        self.last_flush = time.time()
+
+        if header and os.path.exists(path) and os.path.getsize(path):
+            file_obj = open(path, 'rb')
+            existing_header = file_obj.read(len(header))
+            file_obj.close()
+            if existing_header != header:
+                print "%s has a different header, moved it to %s" %(path, self.rotate())
+
+    def write(self, data):
+        self.buffer.append(data)
+        if len(self.buffer) >= self.flush_games or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        data = ''.join(self.buffer)
+        self.buffer = []
+
+        file_obj = self.openLocked()
+        try:
+            size = self.dropPartialRecord(file_obj)
+            if size == 0:
+                data = self.header + data
+            file_obj.write(data)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+            if self.rotate_bytes and size + len(data) >= self.rotate_bytes:
+                self.rotate()
+        finally:
+            file_obj.close() # also releases the lock
+
+    def close(self):
+        self.flush()
+
+    def openLocked(self):
+        # Opens the file for appending and locks it. If another process
+        # rotated the file while we waited for the lock, the new file is
+        # opened instead.
+        while True:
+            file_obj = open(self.path, 'a+b')
+            if fcntl is None:
+                return file_obj
+            fcntl.flock(file_obj.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.fstat(file_obj.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return file_obj
+            except OSError:
+                pass
+            file_obj.close()
+
+    def dropPartialRecord(self, file_obj):
+        # Truncates an incomplete last record, and returns the file size.
+        file_obj.seek(0, os.SEEK_END)
+        size = file_obj.tell()
+        if size == 0:
+            return 0
+        if size < len(self.header):
+            good_size = 0
+        elif self.record_size:
+            good_size = size - (size - len(self.header)) % self.record_size
+        else:
+            tail_size = min(size, 65536)
+            file_obj.seek(size - tail_size)
+            tail = file_obj.read(tail_size)
+            end = tail.rfind(self.record_end)
+            good_size = size - tail_size + (end + len(self.record_end) if end >= 0 else 0)
+        if good_size != size:
+            file_obj.truncate(good_size)
+        return good_size
+
+    def rotate(self):
+        # Renames the file to <path>.<timestamp>, and returns the new name.
+        new_path = self.path + '.' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        suffix = 1
+        while os.path.exists(new_path):
+            new_path = '%s.%s-%d' %(self.path, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), suffix)
+            suffix += 1
+        os.rename(self.path, new_path)
+        return new_path
+
+
+class DropRecorder(object):
+    # The source of the new gems that fall into the board (see
+    # fillEmptySpaces()). When recording, gems are drawn at random as usual
+    # and kept in gems; when replaying, the given gems are used in order.
+
+    def __init__(self, gems=None):
+        self.replaying = gems is not None
+        self.gems = list(gems) if gems is not None else []
+        self.position = 0
+
+    def choose(self, possibleGems):
+        if not self.replaying:
+            gem = random.choice(possibleGems)
+            self.gems.append(gem)
+            return gem
+        gem = self.gems[self.position]
+        self.position += 1
+        return gem
+
+
+class GameTrace(object):
+    # The record of a game: its initial board, and every swap made, with
+    # the gems that fell after it. The random gems are kept rather than
+    # their seed, since the solvers draw from the same generator; a
+    # replay thus needs neither the seed nor the solver.
+    # moves is a list of (x, y, direction, drops), where (x, y) is the
+    # top or left gem of the swap, direction is RIGHT or DOWN and drops
+    # is the list of gems that fell.
+
+    def __init__(self, seed, game_index, width, height, num_gems, algo, goal_score):
+        self.seed = seed
+        self.game_index = game_index
+        self.width = width
+        self.height = height
+        self.num_gems = num_gems
+        self.algo = algo
+        self.goal_score = goal_score
+        self.score = 0
+        self.initial_cells = None
+        self.moves = []
+
+    def addMove(self, firstSwappingGem, secondSwappingGem, drops):
+        x = min(firstSwappingGem['x'], secondSwappingGem['x'])
+        y = min(firstSwappingGem['y'], secondSwappingGem['y'])
+        direction = RIGHT if firstSwappingGem['y'] == secondSwappingGem['y'] else DOWN
+        self.moves.append((x, y, direction, drops))
+
+    def pack(self):
+        # A move takes 2 bytes for the swap, 1 for the number of gems that
+        # fell (3 if 255 or more), and half a byte per gem.
+        parts = [packNibbles(self.initial_cells)]
+        for x, y, direction, drops in self.moves:
+            parts.append(struct.pack('<H', (x * self.height + y) * 2 + (direction == DOWN)))
+            if len(drops) < 255:
+                parts.append(chr(len(drops)))
+            else:
+                parts.append('\xff' + struct.pack('<H', len(drops)))
+            parts.append(packNibbles(drops))
+        payload = ''.join(parts)
+        algo_number = [number for number in ALGOS if ALGOS[number] == self.algo] or [0]
+        return TRACE_FRAME.pack('GAME', self.seed, self.game_index, self.width, self.height, self.num_gems,
+                                algo_number[0], self.goal_score, self.score, len(payload)) + payload + TRACE_END
+
+def unpackGameTrace(frame, payload):
+    # Rebuilds a GameTrace from a frame header tuple and its payload.
+    magic, seed, game_index, width, height, num_gems, algo_number, goal_score, score, size = frame
+    trace = GameTrace(seed, game_index, width, height, num_gems, ALGOS.get(algo_number), goal_score)
+    trace.score = score
+    ncells = width * height
+    trace.initial_cells = unpackNibbles(payload, ncells)
+    position = (ncells + 1) // 2
+    while position < len(payload):
+        code, ndrops = struct.unpack_from('<HB', payload, position)
+        position += 3
+        if ndrops == 255:
+            ndrops = struct.unpack_from('<H', payload, position)[0]
+            position += 2
+        drops = unpackNibbles(payload[position:position + (ndrops + 1) // 2], ndrops)
+        position += (ndrops + 1) // 2
+        x, y = divmod(code // 2, height)
+        trace.moves.append((x, y, DOWN if code % 2 else RIGHT, drops))
+    return trace
+
+def packNibbles(values):
+    # Packs small non-negative integers (< 16) two to a byte.
+    values = list(values)
+    if len(values) % 2:
+        values.append(0)
+    return ''.join([chr(values[i] | values[i + 1] << 4) for i in range(0, len(values), 2)])
+
+def unpackNibbles(data, count):
+    values = []
+    for byte in data:
+        values.append(ord(byte) & 15)
+        values.append(ord(byte) >> 4)
+    return values[:count]
+
+def readGameTraces(path, offsets=None):
+    # Yields (offset, frame, payload) for the games in a trace file,
+    # or only for the frames at the given offsets. frame is the tuple of
+    # TRACE_FRAME fields, and payload is None unless offsets are given,
+    # so that scanning a file reads only the frame headers.
+    file_obj = open(path, 'rb')
+    try:
+        if file_obj.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError("%s is not a game trace file of this version" %path)
+        positions = iter(offsets) if offsets is not None else None
+        offset = file_obj.tell()
+        while True:
+            if positions is not None:
+                offset = next(positions, None)
+                if offset is None:
+                    break
+                file_obj.seek(offset)
+            data = file_obj.read(TRACE_FRAME.size)
+            if len(data) < TRACE_FRAME.size:
+                break
+            frame = TRACE_FRAME.unpack(data)
+            if frame[0] != 'GAME':
+                raise ValueError("%s: bad game frame at offset %d" %(path, offset))
+            payload = None
+            if positions is not None:
+                payload = file_obj.read(frame[-1])
+            else:
+                file_obj.seek(frame[-1] + len(TRACE_END), os.SEEK_CUR)
+            yield offset, frame, payload
+            offset += TRACE_FRAME.size + frame[-1] + len(TRACE_END)
+    finally:
+        file_obj.close()
+
+def getTraceIndex(path):
+    # Maps (base seed, game index) to the offset of the game's frame. A
+    # game recorded twice maps to its last recording.
+    return dict([((frame[1], frame[2]), offset) for offset, frame, payload in readGameTraces(path)])
+
+def loadGameTrace(path, offset):
+    for offset, frame, payload in readGameTraces(path, [offset]):
+        return unpackGameTrace(frame, payload)
+
+def replayGame(trace, simulation=True):
+    # Replays a trace without a solver, and yields (moves, score, board)
+    # before the first move and after every move. The board is changed in
+    # place between yields. With simulation=False, the moves are animated
+    # and drawn with draw_window(), which needs initGraphics() and the
+    # board globals set to the trace's configuration.
+    board = Board(trace.width, trace.height, array('b', trace.initial_cells))
+    score = 0
+    draw_window(board, None, score, 0, simulation)
+    yield 0, score, board
+    for i, (x, y, direction, drops) in enumerate(trace.moves):
+        other = {'x': x + 1, 'y': y} if direction == RIGHT else {'x': x, 'y': y + 1}
+        firstSwappingGem, secondSwappingGem = getSwappingGems(board, {'x': x, 'y': y}, other)
+        recorder = DropRecorder(drops)
+        board, score = perform_move(board, firstSwappingGem, secondSwappingGem, score, i, simulation,
+                                    random_fall=True, drops=recorder)
+        if score is None or recorder.position != len(drops):
+            raise ValueError("Move %d of the trace does not replay" %(i + 1))
+        draw_window(board, None, score, i + 1, simulation)
+        yield i + 1, score, board
+
+def getDecisionSummary(decisions):
+    # Aggregates a game's per-decision metrics into the extra log columns:
+    # (decisions, avg_decision_ms, max_decision_ms, nodes_expanded,
+    #  avg_branching, candidate_moves, legal_moves, max_fringe,
+    #  max_visited, cache_hits, budget_hits)
+    if not decisions:
+        return (0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    times = [d['ms'] for d in decisions]
+    expansions = sum([d['expansions'] for d in decisions])
+    legal = sum([d['legal'] for d in decisions])
+    return (len(decisions), mean(times), max(times),
+            sum([d['nodes'] for d in decisions]),
+            float(legal) / expansions if expansions else 0,
+            sum([d['candidates'] for d in decisions]), legal,
+            max([d['max_fringe'] for d in decisions]),
+            max([d['visited'] for d in decisions]),
+            sum([d['cache_hits'] for d in decisions]),
+            sum([d['budget_hit'] for d in decisions]))
+
+def getDecisionLines(game_index, decisions):
+    # One JSON line per decision of the game.
+    lines = []
+    for i, metrics in enumerate(decisions):
+        record = dict(metrics)
+        record['game'] = game_index
+        record['decision'] = i + 1
+        lines.append(json.dumps(record, sort_keys=True) + '\n')
+    return ''.join(lines)
+
+def updateRunMetrics(run_metrics, score, moves, decisions):
+    run_metrics['games'] += 1
+    if score >= GOAL_SCORE:
+        run_metrics['wins'] += 1
+    run_metrics['moves'] += moves
+    run_metrics['decisions'] += len(decisions)
+    run_metrics['decision_ms'] += sum([d['ms'] for d in decisions])
+    run_metrics['nodes'] += sum([d['nodes'] for d in decisions])
+    run_metrics['budget_hits'] += sum([d['budget_hit'] for d in decisions])
+
+def writeMetricsFile(metrics_file, run_metrics):
+    # Rewrites the metrics file with the run's totals, in a plain
+    # "name value" text format monitoring tools can scrape. The file is
+    # written aside and renamed, so readers never see half of it.
+    now = time.time()
+    uptime = now - run_metrics['start']
+    lines = ['# Gemgem run metrics',
+             'gemgem_games_total %d' %run_metrics['games'],
+             'gemgem_wins_total %d' %run_metrics['wins'],
+             'gemgem_moves_total %d' %run_metrics['moves'],
+             'gemgem_decisions_total %d' %run_metrics['decisions'],
+             'gemgem_decision_seconds_total %.3f' %(run_metrics['decision_ms'] / 1000.0),
+             'gemgem_nodes_expanded_total %d' %run_metrics['nodes'],
+             'gemgem_budget_hits_total %d' %run_metrics['budget_hits'],
+             'gemgem_uptime_seconds %.3f' %uptime,
+             'gemgem_games_per_second %.3f' %(run_metrics['games'] / uptime if uptime else 0),
+             'gemgem_last_update_timestamp %d' %now]
+    temp_file = metrics_file + '.tmp'
+    file_obj = open(temp_file, 'w')
+    file_obj.write('\n'.join(lines) + '\n')
+    file_obj.close()
+    os.rename(temp_file, metrics_file)
+    run_metrics['last_write'] = now
+
+class BackgroundSolver(object):
+    # Runs a solver in a thread, so that the window keeps handling events
+    # while it plans, and so that planning the next moves overlaps with
+    # the animation of the last one. start() begins planning for a board
+    # as soon as it is known; getSwaps() returns the plan for a board,
+    # waiting for it (or planning it first, if it was not started).
+    # Only one plan is made at a time, and the main thread must not draw
+    # from the random module while one is made, so that the solver draws
+    # the same numbers as in a headless game.
+
+    def __init__(self, game_solver):
+        self.game_solver = game_solver
+        self.thread = None
+        self.board = None
+        self.score = None
+        self.swaps = None
+        self.error = None
+
+    def start(self, board, score):
+        self.board = board.copy()
+        self.score = score
+        self.swaps = self.error = None
+        self.thread = threading.Thread(target=self.run, args=(board.copy(), score))
+        self.thread.daemon = True # don't keep a closed window's process alive
+        self.thread.start()
+
+    def run(self, board, score):
+        try:
+            self.swaps = self.game_solver.getSwaps(board, score)
+        except:
+            self.error = sys.exc_info()
+
+    def getSwaps(self, board, score):
+        if self.thread is None or self.score != score or self.board.cells != board.cells:
+            self.start(board, score)
+        while self.thread.is_alive():
+            # Waiting with a timeout keeps Ctrl-C working in Python 2.
+            self.thread.join(1.0 / FPS)
+            checkForQuit()
+        self.thread = None
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.swaps
+
+
+def runGame(is_manual=False, game_solver=None, no_graphics=False, trace=None):
     # Plays through a single game. When the game is over, this function returns.
+    # If a GameTrace is given, the game is recorded into it.
 
     # initalize the board
     gameBoard = getBlankBoard()
     score = 0
     total_moves = 0
     fillBoardAndAnimate(gameBoard, [], score, total_moves, simulation=no_graphics, random_fall=True, is_first=True) # Drop the initial gems.
+    if trace is not None:
+        trace.initial_cells = gameBoard.cells.tolist()
     # Draw the board.
     draw_window(gameBoard, None, score, total_moves, simulation=no_graphics)
 
@@ -521,6 +2087,8 @@ def runGame(is_manual=False, game_solver=None, no_graphics=False):
     clickContinueTextSurf = None
 
     swap_list = []
+    # With graphics, the solver plans in the background.
+    background = BackgroundSolver(game_solver) if not is_manual and not no_graphics else None
 
     while True: # main game loop
 
@@ -533,7 +2101,10 @@ def runGame(is_manual=False, game_solver=None, no_graphics=False):
         if not is_manual and not gameIsOver:
             if not swap_list:
                 #print "START SOLVER"
-                swap_list = game_solver.getSwaps(copy.deepcopy(gameBoard), score)
+                if background is not None:
+                    swap_list = background.getSwaps(gameBoard, score)
+                else:
+                    swap_list = game_solver.getSwaps(gameBoard.copy(), score)
                 #print "END SOLVER"
 
                 # print "Swap list:"
@@ -551,21 +2122,20 @@ def runGame(is_manual=False, game_solver=None, no_graphics=False):
                 firstSelectedGem = move.first
                 clickedSpace = move.second
 
-            for event in pygame.event.get():
-                if event.type == QUIT or (event.type == KEYUP and event.key == K_ESCAPE):
-                    pygame.quit()
-                    sys.exit()
+            if not no_graphics:
+                checkForQuit()
 
         else:
             clickedSpace = None
-            for event in pygame.event.get(): # event handling loop
-                if event.type == QUIT or (event.type == KEYUP and event.key == K_ESCAPE):
+            events = pygame.event.get() if not no_graphics else []
+            for event in events: # event handling loop
+                if event.type == pygame.QUIT or (event.type == pygame.KEYUP and event.key == pygame.K_ESCAPE):
                     pygame.quit()
                     sys.exit()
-                elif event.type == KEYUP and event.key == K_BACKSPACE:
+                elif event.type == pygame.KEYUP and event.key == pygame.K_BACKSPACE:
                     return # start a new game
 
-                elif event.type == MOUSEBUTTONUP:
+                elif event.type == pygame.MOUSEBUTTONUP:
                     if gameIsOver:
                         return score, total_moves # after games ends, click to start a new game
 
@@ -580,7 +2150,7 @@ def runGame(is_manual=False, game_solver=None, no_graphics=False):
                             # if not part of a valid drag, deselect both
                             firstSelectedGem = None
                             clickedSpace = None
-                elif event.type == MOUSEBUTTONDOWN:
+                elif event.type == pygame.MOUSEBUTTONDOWN:
                     # this is the start of a mouse click or mouse drag
                     lastMouseDownX, lastMouseDownY = event.pos
 
@@ -597,12 +2167,28 @@ def runGame(is_manual=False, game_solver=None, no_graphics=False):
                 firstSelectedGem = None # deselect the first gem
                 continue
 
+            drops = DropRecorder() if trace is not None else None
+            if background is not None and not swap_list:
+                # Play the move out headless first, and start planning the
+                # next moves on the settled board while the move animates
+                # with the same new gems.
+                drops = DropRecorder()
+                settledBoard, new_score = perform_move(gameBoard.copy(), firstSwappingGem, secondSwappingGem,
+                                                       score, total_moves, simulation=True, random_fall=True,
+                                                       drops=drops)
+                if new_score is not None and new_score < GOAL_SCORE and canMakeMove(settledBoard):
+                    background.start(settledBoard, new_score)
+                drops = DropRecorder(drops.gems)
             new_board, new_score = perform_move(gameBoard, firstSwappingGem, secondSwappingGem,
-                                            score, total_moves, simulation=no_graphics, random_fall=True)
+                                            score, total_moves, simulation=no_graphics, random_fall=True,
+                                            drops=drops)
 
             if new_score is not None:
                 total_moves += 1
                 score = new_score
+                if trace is not None:
+                    trace.addMove(firstSwappingGem, secondSwappingGem, drops.gems)
+                    trace.score = score
 
             firstSelectedGem = None
 
@@ -613,11 +2199,12 @@ def runGame(is_manual=False, game_solver=None, no_graphics=False):
             if is_manual:
                 # Only render the text once. In future iterations, just
                 # use the Surface object already in clickContinueTextSurf
-                clickContinueTextSurf = BASICFONT.render('Final Score: %s (Click to continue)' % (score), 1, GAMEOVERCOLOR, GAMEOVERBGCOLOR)
+                clickContinueTextSurf = getTextSurface('Final Score: %s (Click to continue)' % (score), GAMEOVERCOLOR, GAMEOVERBGCOLOR)
                 clickContinueTextRect = clickContinueTextSurf.get_rect()
                 clickContinueTextRect.center = int(WINDOWWIDTH / 2), int(WINDOWHEIGHT / 2)
                 DISPLAYSURF.blit(clickContinueTextSurf, clickContinueTextRect)
-                pygame.display.update()
+                addOverlay(clickContinueTextRect)
+                updateDisplay()
                 FPSCLOCK.tick(FPS)
             if not is_manual:
                 return score, total_moves
@@ -625,39 +2212,48 @@ def runGame(is_manual=False, game_solver=None, no_graphics=False):
             # Draw the board.
             draw_window(gameBoard, firstSelectedGem, score, total_moves, simulation=no_graphics)
 
+def checkForQuit():
+    # Exits if the window was closed or Esc was pressed. Other events are
+    # dropped.
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT or (event.type == pygame.KEYUP and event.key == pygame.K_ESCAPE):
+            pygame.quit()
+            sys.exit()
+
 def draw_window(board, firstSelectedGem, score, moves, simulation=True):
     if simulation:
         return
-    DISPLAYSURF.fill(BGCOLOR)
     drawBoard(board)
     if firstSelectedGem != None:
         highlightSpace(firstSelectedGem['x'], firstSelectedGem['y'])
     drawScore(score)
     drawMoves(moves)
-    pygame.display.update()
+    updateDisplay()
     FPSCLOCK.tick(FPS)
 
 def perform_single_move(gameBoard, firstSwappingGem, secondSwappingGem, score=0, moves=0, simulation=True, random_fall=False):
     boardCopy = getBoardCopyMinusGems(gameBoard, (firstSwappingGem, secondSwappingGem))
-    gameBoard[firstSwappingGem['x']][firstSwappingGem['y']] = secondSwappingGem['imageNum']
-    gameBoard[secondSwappingGem['x']][secondSwappingGem['y']] = firstSwappingGem['imageNum']
+    gameBoard[firstSwappingGem['x'], firstSwappingGem['y']] = secondSwappingGem['imageNum']
+    gameBoard[secondSwappingGem['x'], secondSwappingGem['y']] = firstSwappingGem['imageNum']
 
     # See if this is a matching move.
-    matchedGems = findMatchingGems(gameBoard)
+    matchedGems = findMatchingGems(gameBoard, ((firstSwappingGem['x'], firstSwappingGem['y']),
+                                               (secondSwappingGem['x'], secondSwappingGem['y'])))
     if not matchedGems:
-        gameBoard[firstSwappingGem['x']][firstSwappingGem['y']] = firstSwappingGem['imageNum']
-        gameBoard[secondSwappingGem['x']][secondSwappingGem['y']] = secondSwappingGem['imageNum']
+        gameBoard[firstSwappingGem['x'], firstSwappingGem['y']] = firstSwappingGem['imageNum']
+        gameBoard[secondSwappingGem['x'], secondSwappingGem['y']] = secondSwappingGem['imageNum']
     else:
         scoreAdd = len(matchedGems)
         refGem = list(matchedGems)[0]
         for gem in matchedGems:
-            gameBoard[gem[0]][gem[1]] = EMPTY_SPACE
+            gameBoard[gem[0], gem[1]] = EMPTY_SPACE
         score += scoreAdd
         # Drop the new gems.
         fillBoardAndAnimate(gameBoard, [], score, moves, simulation, random_fall)
     return gameBoard, score
 
-def perform_move(gameBoard, firstSwappingGem, secondSwappingGem, score=0, moves=0, simulation=True, random_fall=False):
+def perform_move(gameBoard, firstSwappingGem, secondSwappingGem, score=0, moves=0, simulation=True, random_fall=False,
+                 drops=None):
     # Show the swap animation on the screen.
 
     # if simulation:
@@ -670,19 +2266,20 @@ def perform_move(gameBoard, firstSwappingGem, secondSwappingGem, score=0, moves=
         animateMovingGems(boardCopy, [firstSwappingGem, secondSwappingGem], [], score, moves)
 
     # Swap the gems in the board data structure.
-    gameBoard[firstSwappingGem['x']][firstSwappingGem['y']] = secondSwappingGem['imageNum']
-    gameBoard[secondSwappingGem['x']][secondSwappingGem['y']] = firstSwappingGem['imageNum']
+    gameBoard[firstSwappingGem['x'], firstSwappingGem['y']] = secondSwappingGem['imageNum']
+    gameBoard[secondSwappingGem['x'], secondSwappingGem['y']] = firstSwappingGem['imageNum']
 
     # See if this is a matching move.
-    matchedGems = findMatchingGems(gameBoard)
+    matchedGems = findMatchingGems(gameBoard, ((firstSwappingGem['x'], firstSwappingGem['y']),
+                                               (secondSwappingGem['x'], secondSwappingGem['y'])))
     if not matchedGems:
         # Was not a matching move; swap the gems back
         # GAMESOUNDS['bad swap'].play()
         if not simulation:
             animateMovingGems(boardCopy, [firstSwappingGem, secondSwappingGem], [], score, moves)
 
-        gameBoard[firstSwappingGem['x']][firstSwappingGem['y']] = firstSwappingGem['imageNum']
-        gameBoard[secondSwappingGem['x']][secondSwappingGem['y']] = secondSwappingGem['imageNum']
+        gameBoard[firstSwappingGem['x'], firstSwappingGem['y']] = firstSwappingGem['imageNum']
+        gameBoard[secondSwappingGem['x'], secondSwappingGem['y']] = secondSwappingGem['imageNum']
 
         return gameBoard, None
 
@@ -704,33 +2301,61 @@ def perform_move(gameBoard, firstSwappingGem, secondSwappingGem, score=0, moves=
             for gem in matchedGems:
                 #scoreAdd += (10 + (len(gemSet) - 3) * 10)
                 #for gem in gemSet:
-                gameBoard[gem[0]][gem[1]] = EMPTY_SPACE
+                gameBoard[gem[0], gem[1]] = EMPTY_SPACE
 
             # Dont play sounds
             #random.choice(GAMESOUNDS['match']).play()
             score += scoreAdd
 
             # Drop the new gems.
-            fillBoardAndAnimate(gameBoard, points, score, moves, simulation, random_fall)
+            fillBoardAndAnimate(gameBoard, points, score, moves, simulation, random_fall, drops=drops)
 
             # if simulation:
             #     print
             #     printBoard(gameBoard)
 
-            # Check if there are any new matches.
-            matchedGems = findMatchingGems(gameBoard)
+            # Check if there are any new matches. Only the spaces that
+            # were refilled above the removed gems can be part of one.
+            matchedGems = findMatchingGems(gameBoard, getDroppedSpaces(matchedGems))
 
     return gameBoard, score
 
+def simulateRandomSwap(board, swap, rng):
+    # A fast version of perform_move() with random falls, for MCTS
+    # rollouts: makes the (x, y, direction) swap, which must make a match,
+    # on board in place and plays out the cascade, refilling with gems
+    # drawn from rng. Each affected column is collapsed and refilled in
+    # one go. Returns the points gained.
+    x1, y1, direction = swap
+    x2, y2 = (x1 + 1, y1) if direction == RIGHT else (x1, y1 + 1)
+    height = board.height
+    cells = board.writable()
+    first = x1 * height + y1
+    second = x2 * height + y2
+    cells[first], cells[second] = cells[second], cells[first]
+
+    gained = 0
+    matchedGems = findMatchingGems(board, ((x1, y1), (x2, y2)))
+    while matchedGems:
+        gained += len(matchedGems)
+        for x, y in matchedGems:
+            cells[x * height + y] = EMPTY_SPACE
+        for x in set([x for x, y in matchedGems]):
+            column = [gem for gem in cells[x * height:(x + 1) * height] if gem != EMPTY_SPACE]
+            newGems = [rng.randrange(NUMGEMIMAGES) for i in range(height - len(column))]
+            cells[x * height:(x + 1) * height] = array('b', newGems + column)
+        matchedGems = findMatchingGems(board, getDroppedSpaces(matchedGems))
+    return gained
+
 def getSwappingGems(board, firstXY, secondXY):
     # If the gems at the (X, Y) coordinates of the two gems are adjacent,
     # then their 'direction' keys are set to the appropriate direction
     # value to be swapped with each other.
     # Otherwise, (None, None) is returned.
-    firstGem = {'imageNum': board[firstXY['x']][firstXY['y']],
+    firstGem = {'imageNum': board[firstXY['x'], firstXY['y']],
                 'x': firstXY['x'],
                 'y': firstXY['y']}
-    secondGem = {'imageNum': board[secondXY['x']][secondXY['y']],
+    secondGem = {'imageNum': board[secondXY['x'], secondXY['y']],
                  'x': secondXY['x'],
                  'y': secondXY['y']}
     highlightedGem = None
@@ -753,10 +2378,7 @@ def getSwappingGems(board, firstXY, secondXY):
 
 def getBlankBoard():
     # Create and return a blank board data structure.
-    board = []
-    for x in range(BOARDWIDTH):
-        board.append([EMPTY_SPACE] * BOARDHEIGHT)
-    return board
+    return Board(BOARDWIDTH, BOARDHEIGHT)
 
 def canMakeMove(board):
     # Return True if the board is in a state where a matching
@@ -803,6 +2425,154 @@ def canMakeMove(board):
                     return True # return True the first time you find a pattern
     return False
 
+def getBoardFeatures(board, count_moves=True, area=None):
+    # Computes the board heuristics of the Solver in one pass over the
+    # board, and returns them as (pairs, nmoves, touching): the number of
+    # neighboring spaces with the same gem, of legal swaps, and of gems
+    # next to an empty space. Legal moves are only counted if count_moves
+    # is True (otherwise nmoves is 0).
+    # Each space counts the pairs and legal swaps with its RIGHT and DOWN
+    # neighbors, and whether it is touching; with an area (left, right,
+    # top, bottom), only the spaces in it are counted.
+    width = board.width
+    height = board.height
+    cells = board.cells[:] # swaps are tried (and undone) on this copy
+    pairs = nmoves = touching = 0
+    left, right, top, bottom = area or (0, width - 1, 0, height - 1)
+
+    for x in range(left, right + 1):
+        base = x * height
+        for y in range(top, bottom + 1):
+            # Space (x, y) is cells[i]; its right neighbor is
+            # cells[i + height] and the one below it is cells[i + 1].
+            i = base + y
+            if count_moves:
+                if x + 1 < width and swapMakesMatch(cells, width, height, x, y, x + 1, y):
+                    nmoves += 1
+                if y + 1 < height and swapMakesMatch(cells, width, height, x, y, x, y + 1):
+                    nmoves += 1
+
+            gem = cells[i]
+            if gem == EMPTY_SPACE:
+                continue
+            if x + 1 < width and cells[i + height] == gem:
+                pairs += 1
+            if y + 1 < height and cells[i + 1] == gem:
+                pairs += 1
+            if (y > 0 and cells[i - 1] == EMPTY_SPACE) or \
+               (y + 1 < height and cells[i + 1] == EMPTY_SPACE) or \
+               (x > 0 and cells[i - height] == EMPTY_SPACE) or \
+               (x + 1 < width and cells[i + height] == EMPTY_SPACE):
+                touching += 1
+
+    return pairs, nmoves, touching
+
+def getChangedArea(board, other):
+    # Returns the smallest (left, right, top, bottom) area outside of
+    # which the two boards are the same, or None if they are the same.
+    height = board.height
+    cells = board.cells
+    otherCells = other.cells
+    left = right = None
+    top = height
+    bottom = -1
+    for x in range(board.width):
+        base = x * height
+        if cells[base:base + height] == otherCells[base:base + height]:
+            continue
+        if left is None:
+            left = x
+        right = x
+        y = 0
+        while cells[base + y] == otherCells[base + y]:
+            y += 1
+        top = min(top, y)
+        y = height - 1
+        while cells[base + y] == otherCells[base + y]:
+            y -= 1
+        bottom = max(bottom, y)
+    if left is None:
+        return None
+    return left, right, top, bottom
+
+def getBoardFeaturesAfter(board, features, dest_board, count_moves=True):
+    # Returns getBoardFeatures(dest_board), given the features of board,
+    # by recounting only the spaces whose counts may differ. A space's
+    # counts only depend on the spaces up to FEATURESREACH spaces away
+    # (a swap's run needs 2 more gems on either side), so those are the
+    # spaces around the area where the boards differ.
+    changed = getChangedArea(board, dest_board)
+    if changed is None:
+        return features
+    left, right, top, bottom = changed
+    area = (max(0, left - FEATURESREACH), min(board.width - 1, right + FEATURESREACH),
+            max(0, top - FEATURESREACH), min(board.height - 1, bottom + FEATURESREACH))
+    if 2 * (area[1] - area[0] + 1) * (area[3] - area[2] + 1) > board.width * board.height:
+        # Most of the board changed; recounting all of it is cheaper.
+        return getBoardFeatures(dest_board, count_moves)
+    before = getBoardFeatures(board, count_moves, area)
+    after = getBoardFeatures(dest_board, count_moves, area)
+    return tuple([total - old + new for total, old, new in zip(features, before, after)])
+
+def getSwapSlotNumber(board):
+    # The number of RIGHT and DOWN swaps on a board, legal or not.
+    return (board.width - 1) * board.height + board.width * (board.height - 1)
+
+def getLegalSwaps(board):
+    # Returns a list of (x, y, direction) tuples, one for every swap of a
+    # gem with its RIGHT or DOWN neighbor that makes a match, in the order
+    # of rows, then columns, then RIGHT before DOWN. Nothing is simulated:
+    # on a board with no matches, a swap makes one only if one of the two
+    # swapped gems ends up in a run of 3 or more, so each swap is judged
+    # by looking at the runs through its two spaces.
+    width = board.width
+    height = board.height
+    cells = board.cells[:] # swaps are tried (and undone) on this copy
+
+    swaps = []
+    for y in range(height):
+        for x in range(width):
+            if x + 1 < width and swapMakesMatch(cells, width, height, x, y, x + 1, y):
+                swaps.append((x, y, RIGHT))
+            if y + 1 < height and swapMakesMatch(cells, width, height, x, y, x, y + 1):
+                swaps.append((x, y, DOWN))
+    return swaps
+
+def swapMakesMatch(cells, width, height, x1, y1, x2, y2):
+    # Swaps the gems at (x1, y1) and (x2, y2) in the flat cells array,
+    # checks the runs through both spaces, and swaps them back.
+    first = x1 * height + y1
+    second = x2 * height + y2
+    if cells[first] == cells[second]:
+        return False
+    cells[first], cells[second] = cells[second], cells[first]
+    matched = isInRun(cells, width, height, x1, y1) or isInRun(cells, width, height, x2, y2)
+    cells[first], cells[second] = cells[second], cells[first]
+    return matched
+
+def isInRun(cells, width, height, x, y):
+    # Return True if the gem at (x, y) is part of a vertical or horizontal
+    # run of 3 or more identical gems.
+    gem = cells[x * height + y]
+    if gem == EMPTY_SPACE:
+        return False
+
+    base = x * height
+    top = bottom = y
+    while top > 0 and cells[base + top - 1] == gem:
+        top -= 1
+    while bottom < height - 1 and cells[base + bottom + 1] == gem:
+        bottom += 1
+    if bottom - top >= 2:
+        return True
+
+    left = right = x
+    while left > 0 and cells[(left - 1) * height + y] == gem:
+        left -= 1
+    while right < width - 1 and cells[(right + 1) * height + y] == gem:
+        right += 1
+    return right - left >= 2
+
 def drawMovingGem(gem, progress):
     # Draw a gem sliding in the direction that its 'direction' key
     # indicates. The progress parameter is a number from 0 (just
@@ -810,7 +2580,7 @@ def drawMovingGem(gem, progress):
 
     movex = 0
     movey = 0
-    progress *= 0.01
+    progress *= 0.01 * gem.get('distance', 1) # falling gems may move several spaces
 
     if gem['direction'] == UP:
         movey = -int(progress * GEMIMAGESIZE)
@@ -830,170 +2600,229 @@ def drawMovingGem(gem, progress):
     pixely = YMARGIN + (basey * GEMIMAGESIZE)
     r = pygame.Rect( (pixelx + movex, pixely + movey, GEMIMAGESIZE, GEMIMAGESIZE) )
     DISPLAYSURF.blit(GEMIMAGES[gem['imageNum']], r)
+    addOverlay(r)
 
 def pullDownAllGems(board):
     # pulls down gems on the board to the bottom to fill in any gaps
     for x in range(BOARDWIDTH):
-        gemsInColumn = []
-        for y in range(BOARDHEIGHT):
-            if board[x][y] != EMPTY_SPACE:
-                gemsInColumn.append(board[x][y])
-        board[x] = ([EMPTY_SPACE] * (BOARDHEIGHT - len(gemsInColumn))) + gemsInColumn
+        column = board.column(x)
+        if EMPTY_SPACE not in column:
+            continue
+        gemsInColumn = [gem for gem in column if gem != EMPTY_SPACE]
+        board.setColumn(x, ([EMPTY_SPACE] * (BOARDHEIGHT - len(gemsInColumn))) + gemsInColumn)
 
 def getGemAt(board, x, y):
     if x < 0 or y < 0 or x >= BOARDWIDTH or y >= BOARDHEIGHT:
         return None
     else:
-        return board[x][y]
-
-def getDropSlots(board, simulation=True, random_fall=False, is_first=False):
-    # Creates a "drop slot" for each column and fills the slot with a
-    # number of gems that that column is lacking. This function assumes
-    # that the gems have been gravity dropped already.
-
-
+        return board[x, y]
+
+def fillEmptySpaces(board, is_first=False, drops=None):
+    # Pulls the gems of the board down, and fills the empty spaces left at
+    # the top of each column with new gems, bottom up, which is where they
+    # end up after falling in. Returns the new gems of each column, lowest
+    # first (the "drop slots").
+    # The new gems come from drops (a DropRecorder) if one is given.
+    pullDownAllGems(board)
     dropSlots = []
-    for i in range(BOARDWIDTH):
-        dropSlots.append([])
-
-    if simulation and not random_fall:
-        return dropSlots
-
-    boardCopy = copy.deepcopy(board)
-    pullDownAllGems(boardCopy)
-
-    # count the number of empty spaces in each column on the board
     for x in range(BOARDWIDTH):
-        for y in range(BOARDHEIGHT-1, -1, -1): # start from bottom, going up
-            if boardCopy[x][y] == EMPTY_SPACE:
-                possibleGems = list(range(len(GEMIMAGES)))
-                if is_first:
-                    for offsetX, offsetY in ((0, -1), (1, 0), (0, 1), (-1, 0)):
-                        # Narrow down the possible gems we should put in the
-                        # blank space so we don't end up putting an two of
-                        # the same gems next to each other when they drop.
-                        neighborGem = getGemAt(boardCopy, x + offsetX, y + offsetY)
-                        if neighborGem != None and neighborGem in possibleGems:
-                            possibleGems.remove(neighborGem)
-
+        dropSlots.append([])
+        emptySpaces = board.column(x).count(EMPTY_SPACE)
+        for y in range(emptySpaces - 1, -1, -1): # start from bottom, going up
+            possibleGems = list(range(NUMGEMIMAGES))
+            if is_first:
+                for offsetX, offsetY in ((0, -1), (1, 0), (0, 1), (-1, 0)):
+                    # Narrow down the possible gems we should put in the
+                    # blank space so we don't end up putting an two of
+                    # the same gems next to each other when they drop.
+                    neighborGem = getGemAt(board, x + offsetX, y + offsetY)
+                    if neighborGem != None and neighborGem in possibleGems:
+                        possibleGems.remove(neighborGem)
+
+            if drops is not None:
+                newGem = drops.choose(possibleGems)
+            else:
                 newGem = random.choice(possibleGems)
-                boardCopy[x][y] = newGem
-                dropSlots[x].append(newGem)
+            if is_first:
+                board[x, y] = newGem # the next gem up is checked against it
+            dropSlots[x].append(newGem)
+        if emptySpaces and not is_first:
+            board.setColumn(x, dropSlots[x][::-1] + board.column(x)[emptySpaces:])
     return dropSlots
 
-def findMatchingGems(board):
-    gemsToRemove = set() # a list of lists of gems in matching triplets that
+def findMatchingGems(board, dirty=None):
+    # dirty is an optional iterable of (x, y) spaces that changed since the
+    # board was last free of matches (e.g. the two swapped gems, or the
+    # spaces returned by getDroppedSpaces()). Any new match must run
+    # through one of them, so only their rows and columns are checked.
+    if dirty is not None:
+        return findMatchingGemsAt(board, dirty)
+
+    gemsToRemove = set() # a set of (x, y) spaces in matching runs that
     # should be removed
-    boardCopy = copy.deepcopy(board)
+    cells = board.cells
+    width = board.width
+    height = board.height
+
+    # Scan each column, then each row, for runs of 3 or more identical
+    # gems. Space (x, y) is cells[x * height + y].
+    for x in range(width):
+        base = x * height
+        y = 0
+        while y < height - 2:
+            targetGem = cells[base + y]
+            end = y + 1
+            while end < height and cells[base + end] == targetGem:
+                end += 1
+            if end - y >= 3 and targetGem != EMPTY_SPACE:
+                for offset in range(y, end):
+                    gemsToRemove.add((x, offset))
+            y = end
+
+    for y in range(height):
+        x = 0
+        while x < width - 2:
+            targetGem = cells[x * height + y]
+            end = x + 1
+            while end < width and cells[end * height + y] == targetGem:
+                end += 1
+            if end - x >= 3 and targetGem != EMPTY_SPACE:
+                for offset in range(x, end):
+                    gemsToRemove.add((offset, y))
+            x = end
 
-    # loop through each space, checking for 3 adjacent identical gems
-    for x in range(BOARDWIDTH):
-        for y in range(BOARDHEIGHT):
+    return gemsToRemove
 
-            # look for horizontal matches
-            if getGemAt(boardCopy, x, y) == getGemAt(boardCopy, x + 1, y) == getGemAt(boardCopy, x + 2, y) and getGemAt(boardCopy, x, y) != EMPTY_SPACE:
-                targetGem = boardCopy[x][y]
-                offset = 0
-                while getGemAt(boardCopy, x + offset, y) == targetGem:
-                    # keep checking if there's more than 3 gems in a row
-                    gemsToRemove.add((x + offset, y))
-                    offset += 1
-
-            # look for vertical matches
-            if getGemAt(boardCopy, x, y) == getGemAt(boardCopy, x, y + 1) == getGemAt(boardCopy, x, y + 2) and getGemAt(boardCopy, x, y) != EMPTY_SPACE:
-                targetGem = boardCopy[x][y]
-                offset = 0
-                while getGemAt(boardCopy, x, y + offset) == targetGem:
-                    # keep checking, in case there's more than 3 gems in a row
-                    gemsToRemove.add((x, y + offset))
-                    offset += 1
+def findMatchingGemsAt(board, dirty):
+    # Returns the same set as findMatchingGems(), but only looks at the
+    # vertical and horizontal runs passing through the dirty spaces.
+    gemsToRemove = set()
+    cells = board.cells
+    width = board.width
+    height = board.height
+    checkedVertical = set()
+    checkedHorizontal = set()
+
+    for x, y in dirty:
+        targetGem = cells[x * height + y]
+        if targetGem == EMPTY_SPACE:
+            continue
+
+        # look for a vertical match through (x, y)
+        if (x, y) not in checkedVertical:
+            base = x * height
+            top = bottom = y
+            while top > 0 and cells[base + top - 1] == targetGem:
+                top -= 1
+            while bottom < height - 1 and cells[base + bottom + 1] == targetGem:
+                bottom += 1
+            run = [(x, offset) for offset in range(top, bottom + 1)]
+            checkedVertical.update(run)
+            if len(run) >= 3:
+                gemsToRemove.update(run)
+
+        # look for a horizontal match through (x, y)
+        if (x, y) not in checkedHorizontal:
+            left = right = x
+            while left > 0 and cells[(left - 1) * height + y] == targetGem:
+                left -= 1
+            while right < width - 1 and cells[(right + 1) * height + y] == targetGem:
+                right += 1
+            run = [(offset, y) for offset in range(left, right + 1)]
+            checkedHorizontal.update(run)
+            if len(run) >= 3:
+                gemsToRemove.update(run)
 
     return gemsToRemove
 
+def getDroppedSpaces(removedGems):
+    # Returns the spaces whose gems may change when removedGems are taken
+    # off the board and the columns above them fall down (and refill):
+    # every space in each affected column, down to its lowest removed gem.
+    lowest = {}
+    for x, y in removedGems:
+        if y > lowest.get(x, -1):
+            lowest[x] = y
+    return [(x, y) for x in lowest for y in range(lowest[x] + 1)]
+
 def highlightSpace(x, y):
     pygame.draw.rect(DISPLAYSURF, HIGHLIGHTCOLOR, BOARDRECTS[x][y], 4)
-
-def getDroppingGems(board):
-    # Find all the gems that have an empty space below them
-    boardCopy = copy.deepcopy(board)
-    droppingGems = []
-    for x in range(BOARDWIDTH):
-        for y in range(BOARDHEIGHT - 2, -1, -1):
-            if boardCopy[x][y + 1] == EMPTY_SPACE and boardCopy[x][y] != EMPTY_SPACE:
-                # This space drops if not empty but the space below it is
-                droppingGems.append( {'imageNum': boardCopy[x][y], 'x': x, 'y': y, 'direction': DOWN} )
-                boardCopy[x][y] = EMPTY_SPACE
-    return droppingGems
+    addOverlay(BOARDRECTS[x][y])
 
 def animateMovingGems(board, gems, pointsText, score, moves):
     # pointsText is a dictionary with keys 'x', 'y', and 'points'
-    progress = 0 # progress at 0 represents beginning, 100 means finished.
-    while progress < 100: # animation loop
-        DISPLAYSURF.fill(BGCOLOR)
+    # The animation is driven by the elapsed time, not by the number of
+    # frames drawn: a gem moves one space in ANIMATIONTIME seconds, and
+    # gems with a 'distance' key fall that many spaces, speeding up like
+    # under gravity. FPS only caps the number of frames drawn meanwhile.
+    if FASTFORWARD:
+        return
+    start = time.time()
+    while True: # animation loop
+        elapsed = (time.time() - start) / ANIMATIONTIME
+        progresses = [getMoveProgress(gem, elapsed) for gem in gems]
+        if all(progress >= 100 for progress in progresses):
+            break
         drawBoard(board)
-        for gem in gems: # Draw each gem.
+        for gem, progress in zip(gems, progresses): # Draw each gem.
             drawMovingGem(gem, progress)
         drawScore(score)
         drawMoves(moves)
         for pointText in pointsText:
-            pointsSurf = BASICFONT.render(str(pointText['points']), 1, SCORECOLOR)
+            pointsSurf = getTextSurface(str(pointText['points']), SCORECOLOR)
             pointsRect = pointsSurf.get_rect()
             pointsRect.center = (pointText['x'], pointText['y'])
             DISPLAYSURF.blit(pointsSurf, pointsRect)
+            addOverlay(pointsRect)
 
-        pygame.display.update()
+        updateDisplay()
         FPSCLOCK.tick(FPS)
-        progress += MOVERATE # progress the animation a little bit more for the next frame
-
-def moveGems(board, movingGems):
-    # movingGems is a list of dicts with keys x, y, direction, imageNum
-    for gem in movingGems:
-        if gem['y'] != ROWABOVEBOARD:
-            board[gem['x']][gem['y']] = EMPTY_SPACE
-            movex = 0
-            movey = 0
-            if gem['direction'] == LEFT:
-                movex = -1
-            elif gem['direction'] == RIGHT:
-                movex = 1
-            elif gem['direction'] == DOWN:
-                movey = 1
-            elif gem['direction'] == UP:
-                movey = -1
-            board[gem['x'] + movex][gem['y'] + movey] = gem['imageNum']
-        else:
-            # gem is located above the board (where new gems come from)
-            board[gem['x']][0] = gem['imageNum'] # move to top row
 
-def fillBoardAndAnimate(board, points, score, moves, simulation=True, random_fall=False, is_first=False):
+def getMoveProgress(gem, elapsed):
+    # Returns how far along its move a gem is after elapsed animation
+    # times, from 0 (just starting) to 100 (move complete).
+    if 'distance' not in gem:
+        return min(100, 100 * elapsed)
+    return min(100, 100 * elapsed ** 2 / gem['distance'])
+
+def fillBoardAndAnimate(board, points, score, moves, simulation=True, random_fall=False, is_first=False, drops=None):
 
     if simulation and not random_fall:
         pullDownAllGems(board)
         return
 
-    dropSlots = getDropSlots(board, simulation, random_fall, is_first)
-
-    while dropSlots != ([[]] * BOARDWIDTH):
-        # do the dropping animation as long as there are more gems to drop
-        movingGems = getDroppingGems(board)
-        for x in range(len(dropSlots)):
-            if len(dropSlots[x]) != 0:
-                # cause the lowest gem in each slot to begin moving in the DOWN direction
-                movingGems.append({'imageNum': dropSlots[x][0], 'x': x, 'y': ROWABOVEBOARD, 'direction': DOWN})
+    if simulation:
+        # Nothing is drawn, so the gems need not fall row by row: each
+        # column is collapsed and refilled in a single pass.
+        fillEmptySpaces(board, is_first, drops)
+        return
 
-        boardCopy = getBoardCopyMinusGems(board, movingGems)
-        if not simulation:
-            animateMovingGems(boardCopy, movingGems, points, score, moves)
+    settledBoard = board.copy()
+    dropSlots = fillEmptySpaces(settledBoard, is_first, drops)
 
-        moveGems(board, movingGems)
+    # All the gems fall to their places at once.
+    fallingGems = getFallingGems(board, dropSlots)
+    animateMovingGems(getBoardCopyMinusGems(board, fallingGems), fallingGems, points, score, moves)
+    for x in range(BOARDWIDTH):
+        board.setColumn(x, settledBoard.column(x))
 
-        # Make the next row of gems from the drop slots
-        # the lowest by deleting the previous lowest gems.
-        for x in range(len(dropSlots)):
-            if len(dropSlots[x]) == 0:
-                continue
-            board[x][0] = dropSlots[x][0]
-            del dropSlots[x][0]
+def getFallingGems(board, dropSlots):
+    # Returns the gems that move when the board is pulled down and the
+    # gems in dropSlots fill its top, each with the number of spaces it
+    # falls. The new gems start in the rows above the board (negative y).
+    fallingGems = []
+    for x in range(BOARDWIDTH):
+        emptySpaces = 0
+        for y in range(BOARDHEIGHT - 1, -1, -1):
+            if board[x, y] == EMPTY_SPACE:
+                emptySpaces += 1
+            elif emptySpaces:
+                fallingGems.append({'imageNum': board[x, y], 'x': x, 'y': y, 'direction': DOWN,
+                                    'distance': emptySpaces})
+        for i, gem in enumerate(dropSlots[x]):
+            fallingGems.append({'imageNum': gem, 'x': x, 'y': -1 - i, 'direction': DOWN,
+                                'distance': len(dropSlots[x])})
+    return fallingGems
 
 def checkForGemClick(pos):
     # See if the mouse click was on the board
@@ -1004,12 +2833,101 @@ def checkForGemClick(pos):
     return None # Click was not on the board.
 
 def drawBoard(board):
+    # Starts a frame: erases the last frame's overlays, then redraws only
+    # the spaces whose gem changed since they were drawn.
+    clearOverlays()
+    drawnRects = []
     for x in range(BOARDWIDTH):
         for y in range(BOARDHEIGHT):
-            pygame.draw.rect(DISPLAYSURF, GRIDCOLOR, BOARDRECTS[x][y], 1)
-            gemToDraw = board[x][y]
+            gemToDraw = board[x, y]
+            index = x * BOARDHEIGHT + y
+            if SCREENCELLS[index] == gemToDraw:
+                continue
+            rect = BOARDRECTS[x][y]
+            DISPLAYSURF.blit(BACKGROUND, rect, rect)
             if gemToDraw != EMPTY_SPACE:
-                DISPLAYSURF.blit(GEMIMAGES[gemToDraw], BOARDRECTS[x][y])
+                DISPLAYSURF.blit(GEMIMAGES[gemToDraw], rect)
+            SCREENCELLS[index] = gemToDraw
+            drawnRects.append(rect)
+    DIRTYRECTS.extend(drawnRects)
+    if drawnRects:
+        # Texts the redrawn spaces covered are drawn again.
+        for slot, (text, rect) in SCREENTEXTS.items():
+            if rect.collidelist(drawnRects) != -1:
+                SCREENTEXTS[slot] = (None, rect)
+
+def addOverlay(rect):
+    # Marks rect as drawn over the board, to be erased in the next frame.
+    rect = rect.clip(DISPLAYSURF.get_rect()) # gems fall in from above the window
+    if rect not in OVERLAYS:
+        OVERLAYS.append(rect)
+        DIRTYRECTS.append(rect)
+
+def clearOverlays():
+    # Restores the background under the last frame's overlays, and marks
+    # the spaces and texts under them for redrawing.
+    for rect in OVERLAYS:
+        DISPLAYSURF.blit(BACKGROUND, rect, rect)
+        DIRTYRECTS.append(rect)
+        forgetDrawnArea(rect)
+    del OVERLAYS[:]
+
+def forgetDrawnArea(rect):
+    # Marks the spaces and texts that overlap rect for redrawing.
+    left = max(0, (rect.left - XMARGIN) // GEMIMAGESIZE)
+    right = min(BOARDWIDTH - 1, (rect.right - 1 - XMARGIN) // GEMIMAGESIZE)
+    top = max(0, (rect.top - YMARGIN) // GEMIMAGESIZE)
+    bottom = min(BOARDHEIGHT - 1, (rect.bottom - 1 - YMARGIN) // GEMIMAGESIZE)
+    for x in range(left, right + 1):
+        for y in range(top, bottom + 1):
+            SCREENCELLS[x * BOARDHEIGHT + y] = None
+    for slot, (text, textRect) in SCREENTEXTS.items():
+        if textRect.colliderect(rect):
+            SCREENTEXTS[slot] = (None, textRect)
+
+def restoreArea(rect):
+    # Draws the background and the parts of the drawn gems inside rect.
+    DISPLAYSURF.blit(BACKGROUND, rect, rect)
+    for x in range(BOARDWIDTH):
+        for y in range(BOARDHEIGHT):
+            gem = SCREENCELLS[x * BOARDHEIGHT + y]
+            cellRect = BOARDRECTS[x][y]
+            if gem is None or gem == EMPTY_SPACE or not cellRect.colliderect(rect):
+                continue
+            area = cellRect.clip(rect)
+            DISPLAYSURF.blit(GEMIMAGES[gem], area, area.move(-cellRect.left, -cellRect.top))
+    DIRTYRECTS.append(rect)
+
+def updateDisplay():
+    # Pushes only the changed parts of the window to the screen.
+    pygame.display.update(DIRTYRECTS)
+    del DIRTYRECTS[:]
+
+def getTextSurface(text, color, background=None):
+    # Rendered texts are cached; scores and move counts repeat a lot.
+    key = (text, color, background)
+    if key not in TEXTSURFACES:
+        if len(TEXTSURFACES) > 1000:
+            TEXTSURFACES.clear()
+        if background is None:
+            TEXTSURFACES[key] = BASICFONT.render(text, 1, color)
+        else:
+            TEXTSURFACES[key] = BASICFONT.render(text, 1, color, background)
+    return TEXTSURFACES[key]
+
+def drawText(slot, text, color, bottomleft):
+    # Draws text in a slot of the window, unless it is already there.
+    drawn = SCREENTEXTS.get(slot)
+    if drawn is not None and drawn[0] == text:
+        return
+    if drawn is not None:
+        restoreArea(drawn[1])
+    textImg = getTextSurface(text, color)
+    textRect = textImg.get_rect()
+    textRect.bottomleft = bottomleft
+    DISPLAYSURF.blit(textImg, textRect)
+    DIRTYRECTS.append(textRect)
+    SCREENTEXTS[slot] = (text, textRect)
 
 def getBoardCopyMinusGems(board, gems):
     # Creates and returns a copy of the passed board data structure,
@@ -1017,37 +2935,28 @@ def getBoardCopyMinusGems(board, gems):
     #
     # Gems is a list of dicts, with keys x, y, direction, imageNum
 
-    boardCopy = copy.deepcopy(board)
+    boardCopy = board.copy()
 
     # Remove some of the gems from this board data structure copy.
 
     for gem in gems:
-        if gem['y'] != ROWABOVEBOARD:
-            boardCopy[gem['x']][gem['y']] = EMPTY_SPACE
+        if gem['y'] != ROWABOVEBOARD and gem['y'] >= 0:
+            boardCopy[gem['x'], gem['y']] = EMPTY_SPACE
 
     return boardCopy
 
 def drawMoves(k):
-    movesImg = BASICFONT.render(str(k), 1, MOVESCOLOR)
-    movesRect = movesImg.get_rect()
-    movesRect.bottomleft = (WINDOWWIDTH - 70, WINDOWHEIGHT - 6)
-    DISPLAYSURF.blit(movesImg, movesRect)
+    drawText('moves', str(k), MOVESCOLOR, (WINDOWWIDTH - 70, WINDOWHEIGHT - 6))
 
 def drawScore(score):
-    scoreImg = BASICFONT.render(str(score), 1, SCORECOLOR)
-    scoreRect = scoreImg.get_rect()
-    scoreRect.bottomleft = (10, WINDOWHEIGHT - 6)
-    DISPLAYSURF.blit(scoreImg, scoreRect)
+    drawText('score', str(score), SCORECOLOR, (10, WINDOWHEIGHT - 6))
 
 def printBoard(board):
     for y in range(BOARDHEIGHT):
         for x in range(BOARDWIDTH):
-            print "%3d" %board[x][y],
+            print "%3d" %board[x, y],
         print
 
-def boardTuple(board):
-    return tuple([tuple(col) for col in board])
-
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option("-m", "--manual",
@@ -1055,7 +2964,13 @@ if __name__ == '__main__':
                       help="Run game with manual control")
     parser.add_option("-s", "--size",
                       type="int", dest="BOARD_SIZE", default=6,
-                      help="Size of game board side (4..8)")
+                      help="Size of game board side (4..%d)" %MAXBOARDSIZE)
+    parser.add_option("--width",
+                      type="int", dest="BOARD_WIDTH", default=None,
+                      help="Number of columns in the board. Defaults to the board size")
+    parser.add_option("--height",
+                      type="int", dest="BOARD_HEIGHT", default=None,
+                      help="Number of rows in the board. Defaults to the board size")
     parser.add_option("-g", "--gems",
                       type="int", dest="GEM_NUM", default=4,
                       help="Number of gem types (4..7)")
@@ -1065,6 +2980,12 @@ if __name__ == '__main__':
     parser.add_option("-f", "--fps",
                       type="int", dest="USER_FPS", default=30,
                       help="Game animation FPS")
+    parser.add_option("--animation-ms",
+                      type="int", dest="ANIMATION_MS", default=int(ANIMATIONTIME * 1000),
+                      help="Milliseconds a swap, or a fall of one space, takes to animate")
+    parser.add_option("--fast-forward",
+                      action="store_true", dest="FAST_FORWARD", default=False,
+                      help="Skip the animations and only show the board after each move")
     parser.add_option("-n", "--ngames",
                       type="int", dest="NGAMES", default=0,
                       help="Number of games to run. Set to 0 to run forever")
@@ -1076,24 +2997,96 @@ if __name__ == '__main__':
                       help="Run game(s) without graphics")
     parser.add_option("-a", "--algorithm",
                       type="int", dest="ALGO", default=1,
-                      help="Algorithm: 1=SGS, 2=HGS, 3=L-BFS")
+                      help="Algorithm: 1=SGS, 2=HGS, 3=L-BFS, 4=Beam, 5=MCTS")
     parser.add_option("-w", "--weights",
                       type="string", dest="WEIGHTS", default="1 1 1 1 1",
                       help="Weights: [Score, Pairs, Moves, Depth, Touching]")
+    parser.add_option("-b", "--beam-width",
+                      type="int", dest="BEAM_WIDTH", default=BEAM_WIDTH,
+                      help="Number of states kept per depth by the beam search")
+    parser.add_option("-d", "--beam-depth",
+                      type="int", dest="BEAM_DEPTH", default=BEAM_DEPTH,
+                      help="Maximal number of moves the beam search looks ahead")
+    parser.add_option("--mcts-ms",
+                      type="int", dest="MCTS_MS", default=MCTS_MS,
+                      help="Milliseconds of tree search per MCTS decision. Set to 0 for no time limit")
+    parser.add_option("--mcts-iterations",
+                      type="int", dest="MCTS_ITERATIONS", default=MCTS_ITERATIONS,
+                      help="Maximal number of MCTS iterations per decision. Set to 0 for no limit")
+    parser.add_option("--mcts-horizon",
+                      type="int", dest="MCTS_HORIZON", default=MCTS_HORIZON,
+                      help="Number of swaps each MCTS iteration plays ahead")
+    parser.add_option("--time-budget-ms",
+                      type="int", dest="TIME_BUDGET_MS", default=TIME_BUDGET_MS,
+                      help="Milliseconds a solver may spend per decision. Set to 0 for no limit")
+    parser.add_option("--max-nodes",
+                      type="int", dest="MAX_NODES", default=MAX_NODES,
+                      help="Number of nodes a solver may expand per decision. Set to 0 for no limit")
+    parser.add_option("--cache-mb",
+                      type="float", dest="CACHE_MB", default=CACHE_MB,
+                      help="Memory cap of the solver's move cache in MB. Set to 0 to disable")
+    parser.add_option("--shared-cache",
+                      type="string", dest="SHARED_CACHE", default=None,
+                      help="Back the move cache with this file, shared by worker processes and later runs")
+    parser.add_option("--shared-cache-mb",
+                      type="float", dest="SHARED_CACHE_MB", default=SHARED_CACHE_MB,
+                      help="Size in MB of a new shared move cache file")
+    parser.add_option("--workers",
+                      type="int", dest="WORKERS", default=1,
+                      help="Number of processes to run games in (requires -q)")
+    parser.add_option("--seed",
+                      type="int", dest="SEED", default=None,
+                      help="Base random seed. Game i is seeded with SEED + i")
+    parser.add_option("--vectorized",
+                      action="store_true", dest="VECTORIZED", default=False,
+                      help="Simulate SGS games in NumPy batches (requires -q and -a 1)")
+    parser.add_option("--batch-size",
+                      type="int", dest="BATCH_SIZE", default=BATCH_SIZE,
+                      help="Number of games per batch of the vectorized simulator")
+    parser.add_option("--decision-log",
+                      type="string", dest="DECISION_LOG", default=None,
+                      help="Write the solver's per-decision metrics to this file as JSON lines")
+    parser.add_option("--metrics-file",
+                      type="string", dest="METRICS_FILE", default=None,
+                      help="Periodically rewrite this file with the run's throughput metrics")
+    parser.add_option("--metrics-interval",
+                      type="float", dest="METRICS_INTERVAL", default=METRICS_INTERVAL,
+                      help="Seconds between rewrites of the metrics file")
+    parser.add_option("--record",
+                      type="string", dest="RECORD", default=None,
+                      help="Record a trace of every game to this file, for gemgem_replay.py")
+    parser.add_option("--flush-games",
+                      type="int", dest="FLUSH_GAMES", default=FLUSH_GAMES,
+                      help="Number of games between writes of the result files")
+    parser.add_option("--flush-seconds",
+                      type="float", dest="FLUSH_SECONDS", default=FLUSH_SECONDS,
+                      help="Maximal number of seconds between writes of the result files")
+    parser.add_option("--rotate-mb",
+                      type="float", dest="ROTATE_MB", default=0,
+                      help="Rotate result files larger than this many MB. Set to 0 to never rotate")
+    parser.add_option("--binary-log",
+                      type="string", dest="BINARY_LOG", default=None,
+                      help="Also write the results to this file in a compact binary format")
+    parser.add_option("--canonical-keys",
+                      action="store_true", dest="CANONICAL_KEYS", default=False,
+                      help="Key the L-BFS visited set and the move cache by a board's normal form under mirroring and color relabelling")
     parser.add_option("-j",
                       action="store_true", dest="JJ", default=False,
                       help="Who knows?")
 
     (options, args) = parser.parse_args()
 
-    BOARDWIDTH = BOARDHEIGHT = options.BOARD_SIZE
+    setBoardSize(options.BOARD_WIDTH if options.BOARD_WIDTH is not None else options.BOARD_SIZE,
+                 options.BOARD_HEIGHT if options.BOARD_HEIGHT is not None else options.BOARD_SIZE)
     NUMGEMIMAGES = options.GEM_NUM
     GOAL_SCORE = options.GOAL
     FPS = options.USER_FPS
+    ANIMATIONTIME = options.ANIMATION_MS / 1000.0
+    FASTFORWARD = options.FAST_FORWARD
     J = options.JJ
 
-    if BOARDWIDTH < 4 or BOARDWIDTH > 8:
-        print "Board size must be in the range 4..8"
+    if not (4 <= BOARDWIDTH <= MAXBOARDSIZE and 4 <= BOARDHEIGHT <= MAXBOARDSIZE):
+        print "Board width and height must be in the range 4..%d" %MAXBOARDSIZE
         parser.print_help()
         sys.exit(1)
 
@@ -1112,13 +3105,18 @@ if __name__ == '__main__':
         parser.print_help()
         sys.exit(1)
 
+    if options.ANIMATION_MS <= 0:
+        print "Animation time must be positive. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
     if options.NGAMES < 0:
         print "Number of games must be non-negative. Terminating"
         parser.print_help()
         sys.exit(1)
 
-    if options.ALGO not in (1,2,3):
-        print "Algorithm must be 1 (SGS), 2 (HGS) or 3 (L-BFS). Terminating"
+    if options.ALGO not in (1,2,3,4,5):
+        print "Algorithm must be 1 (SGS), 2 (HGS), 3 (L-BFS), 4 (Beam) or 5 (MCTS). Terminating"
         parser.print_help()
         sys.exit(1)
 
@@ -1134,4 +3132,66 @@ if __name__ == '__main__':
         parser.print_help()
         sys.exit(1)
 
-    main(options.IS_MANUAL, False, options.NGAMES, ALGOS[options.ALGO], weights, options.NO_GRAPHICS, options.LOGFILE)
+    if options.BEAM_WIDTH < 1 or options.BEAM_DEPTH < 1:
+        print "Beam width and depth must be at least 1. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    if options.MCTS_MS < 0 or options.MCTS_ITERATIONS < 0 or options.MCTS_HORIZON < 1 or \
+            (options.MCTS_MS == 0 and options.MCTS_ITERATIONS == 0):
+        print "MCTS needs a time or iteration limit, and a horizon of at least 1. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    if options.TIME_BUDGET_MS < 0 or options.MAX_NODES < 0:
+        print "Time budget and maximal number of nodes must be non-negative. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    if options.IS_MANUAL and options.NO_GRAPHICS:
+        print "Manual mode requires graphics. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    if options.WORKERS < 1:
+        print "Number of workers must be at least 1. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    if options.WORKERS > 1 and (options.IS_MANUAL or not options.NO_GRAPHICS):
+        print "Multiple workers require auto mode without graphics (-q). Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    if options.VECTORIZED:
+        if options.IS_MANUAL or not options.NO_GRAPHICS or options.ALGO != 1 or options.WORKERS > 1 or options.RECORD:
+            print "The vectorized simulator requires auto mode, -q, -a 1 and a single worker, and cannot record. Terminating"
+            parser.print_help()
+            sys.exit(1)
+        if options.BATCH_SIZE < 1:
+            print "Batch size must be at least 1. Terminating"
+            parser.print_help()
+            sys.exit(1)
+        try:
+            import numpy
+        except ImportError:
+            print "The vectorized simulator requires NumPy. Terminating"
+            sys.exit(1)
+
+    if options.FLUSH_GAMES < 1 or options.FLUSH_SECONDS < 0 or options.ROTATE_MB < 0:
+        print "Flush games must be at least 1, and flush seconds and rotation size non-negative. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    if options.CACHE_MB < 0 or options.SHARED_CACHE_MB <= 0:
+        print "Cache size must be non-negative, and shared cache size positive. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    main(options.IS_MANUAL, False, options.NGAMES, ALGOS[options.ALGO], weights, options.NO_GRAPHICS, options.LOGFILE,
+         options.CACHE_MB, options.BEAM_WIDTH, options.BEAM_DEPTH, options.WORKERS, options.SEED,
+         options.VECTORIZED, options.BATCH_SIZE, options.DECISION_LOG, options.METRICS_FILE,
+         options.METRICS_INTERVAL, options.FLUSH_GAMES, options.FLUSH_SECONDS, options.ROTATE_MB,
+         options.BINARY_LOG, options.MCTS_MS, options.MCTS_ITERATIONS, options.MCTS_HORIZON,
+         options.TIME_BUDGET_MS, options.MAX_NODES, options.SHARED_CACHE, options.SHARED_CACHE_MB,
+         options.RECORD, options.CANONICAL_KEYS)
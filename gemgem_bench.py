@@ -0,0 +1,260 @@
+# Gemgem - micro-benchmarks
+# by Daniel Hadar & Oren Samuel
+# Written for 2014-2015 Intro to AI course
+# Hebrew University of Jerusalem
+
+"""
+Micro-benchmarks for the simulation and solver hot paths of gemgem.py.
+
+Every benchmark runs on the same seeded, settled boards for each board
+size and number of gem types, and reports operations per second and
+latency percentiles. Results can be saved as a JSON baseline, and a later
+run can be compared against it: any benchmark whose median latency grew
+by more than the threshold is flagged, and the exit status is 1.
+
+For example:
+python gemgem_bench.py --save baseline.json
+python gemgem_bench.py --compare baseline.json --threshold 0.2
+python gemgem_bench.py --sizes "6 8" --gems 4 --bench findMatchingGems,perform_move
+"""
+
+import random, sys, time, json, platform, datetime
+from optparse import OptionParser
+
+import gemgem
+
+SIZES = (4, 5, 6, 7, 8)
+GEM_NUMS = (4, 5, 6, 7)
+
+
+def configure(size, num_gems):
+    # gemgem.py keeps the board configuration in module globals.
+    gemgem.setBoardSize(size, size)
+    gemgem.NUMGEMIMAGES = num_gems
+
+def getSettledBoard(seed):
+    # A random board with no matches on it, like the boards the solvers
+    # see during a game.
+    random.seed(seed)
+    board = gemgem.getBlankBoard()
+    gemgem.fillBoardAndAnimate(board, [], 0, 0, simulation=True, random_fall=True)
+    matchedGems = gemgem.findMatchingGems(board)
+    while matchedGems:
+        for x, y in matchedGems:
+            board[x, y] = gemgem.EMPTY_SPACE
+        gemgem.fillBoardAndAnimate(board, [], 0, 0, simulation=True, random_fall=True)
+        matchedGems = gemgem.findMatchingGems(board)
+    return board
+
+def getBoards(nboards):
+    # The first nboards seeded boards that have at least one legal swap.
+    boards = []
+    seed = 0
+    while len(boards) < nboards:
+        board = getSettledBoard(seed)
+        if gemgem.getLegalSwaps(board):
+            boards.append(board)
+        seed += 1
+    return boards
+
+def getSwapDicts(board):
+    x, y, direction = gemgem.getLegalSwaps(board)[0]
+    if direction == gemgem.RIGHT:
+        other = {'x': x + 1, 'y': y}
+    else:
+        other = {'x': x, 'y': y + 1}
+    return gemgem.getSwappingGems(board, {'x': x, 'y': y}, other)
+
+def getBoardMinusMatch(board):
+    # The board right after the first match of its first legal swap was
+    # removed, i.e. what fillBoardAndAnimate() gets during a cascade.
+    first, second = getSwapDicts(board)
+    board = board.copy()
+    board[first['x'], first['y']] = second['imageNum']
+    board[second['x'], second['y']] = first['imageNum']
+    for x, y in gemgem.findMatchingGems(board):
+        board[x, y] = gemgem.EMPTY_SPACE
+    return board
+
+
+#### Benchmarks ####
+# Each benchmark gets the list of seeded boards, and returns a list of
+# (setup, op) pairs. setup() runs untimed and its result is passed to
+# the timed op().
+
+def benchFindMatchingGems(boards):
+    return [(lambda b=b: b, gemgem.findMatchingGems) for b in boards]
+
+def benchPerformMove(boards):
+    cases = []
+    for board in boards:
+        first, second = getSwapDicts(board)
+        cases.append((lambda b=board: b.copy(),
+                      lambda b, f=first, s=second: gemgem.perform_move(b, f, s, simulation=True, random_fall=False)))
+    return cases
+
+def benchFillBoard(boards):
+    return [(lambda b=getBoardMinusMatch(board): b.copy(),
+             lambda b: gemgem.fillBoardAndAnimate(b, [], 0, 0, simulation=True, random_fall=True))
+            for board in boards]
+
+def benchCanMakeMove(boards):
+    return [(lambda b=b: b, gemgem.canMakeMove) for b in boards]
+
+def benchGetPossibleMoves(boards):
+    solver = gemgem.Solver(False, gemgem.LBFS, [1] * 5, cache_mb=0)
+    return [(lambda b=b: b, lambda b: solver.getPossibleMoves(b, True)) for b in boards]
+
+def getMoves(boards):
+    # Heuristics are computed on the boards left after a move.
+    solver = gemgem.Solver(False, gemgem.LBFS, [1] * 5, cache_mb=0)
+    return [solver.getPossibleMoves(board, True)[0] for board in boards]
+
+def benchBoardFeatures(boards):
+    return [(lambda m=m: m.dest_board, gemgem.getBoardFeatures) for m in getMoves(boards)]
+
+def benchBoardFeaturesAfter(boards):
+    # The features of a move's board, worked out from those of its source
+    # board, as the solvers do.
+    cases = []
+    for move in getMoves(boards):
+        features = gemgem.getBoardFeatures(move.source_board)
+        cases.append((lambda m=move: m,
+                      lambda m, f=features: gemgem.getBoardFeaturesAfter(m.source_board, f, m.dest_board)))
+    return cases
+
+BENCHMARKS = [('findMatchingGems', benchFindMatchingGems),
+              ('perform_move', benchPerformMove),
+              ('fillBoardAndAnimate', benchFillBoard),
+              ('canMakeMove', benchCanMakeMove),
+              ('getPossibleMoves', benchGetPossibleMoves),
+              ('getBoardFeatures', benchBoardFeatures),
+              ('getBoardFeaturesAfter', benchBoardFeaturesAfter)]
+
+
+def runCases(cases, rounds):
+    # Times every case rounds times, and returns the latencies in seconds.
+    timer = time.time
+    latencies = []
+    random.seed(0)
+    for i in range(rounds):
+        for setup, op in cases:
+            arg = setup()
+            start = timer()
+            op(arg)
+            latencies.append(timer() - start)
+    return latencies
+
+def percentile(sorted_values, p):
+    index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {'n': len(latencies),
+            'ops_per_sec': len(latencies) / total if total else 0,
+            'p50_us': percentile(latencies, 50) * 1e6,
+            'p90_us': percentile(latencies, 90) * 1e6,
+            'p99_us': percentile(latencies, 99) * 1e6}
+
+def runBenchmarks(sizes, gem_nums, names, nboards, rounds):
+    results = {}
+    print "%-22s %5s %4s %12s %10s %10s %10s" %('benchmark', 'board', 'gems', 'ops/sec', 'p50 us', 'p90 us', 'p99 us')
+    for size in sizes:
+        for num_gems in gem_nums:
+            configure(size, num_gems)
+            boards = getBoards(nboards)
+            for name, bench in BENCHMARKS:
+                if name not in names:
+                    continue
+                stats = summarize(runCases(bench(boards), rounds))
+                results['%s/%dx%d/%d' %(name, size, size, num_gems)] = stats
+                print "%-22s %5s %4d %12.0f %10.1f %10.1f %10.1f" \
+                      %(name, '%dx%d' %(size, size), num_gems, stats['ops_per_sec'],
+                        stats['p50_us'], stats['p90_us'], stats['p99_us'])
+    return results
+
+def compareResults(results, baseline, threshold):
+    # Returns the keys whose median latency grew by more than threshold
+    # (a fraction) relative to the baseline.
+    slower = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old = baseline[key]['p50_us']
+        new = results[key]['p50_us']
+        change = (new - old) / old if old else 0
+        flag = ''
+        if change > threshold:
+            slower.append(key)
+            flag = '  <-- SLOWER'
+        print "%-36s %10.1f -> %10.1f us (%+.0f%%)%s" %(key, old, new, 100 * change, flag)
+    return slower
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--sizes",
+                      type="string", dest="SIZES", default=' '.join(map(str, SIZES)),
+                      help="Board sizes to benchmark")
+    parser.add_option("--gems",
+                      type="string", dest="GEMS", default=' '.join(map(str, GEM_NUMS)),
+                      help="Numbers of gem types to benchmark")
+    parser.add_option("--bench",
+                      type="string", dest="BENCH", default=','.join([name for name, bench in BENCHMARKS]),
+                      help="Comma separated benchmark names")
+    parser.add_option("--boards",
+                      type="int", dest="BOARDS", default=10,
+                      help="Number of seeded boards per configuration")
+    parser.add_option("--rounds",
+                      type="int", dest="ROUNDS", default=20,
+                      help="Number of times each board is timed")
+    parser.add_option("--save",
+                      type="string", dest="SAVE", default=None,
+                      help="Save the results as a JSON baseline to this file")
+    parser.add_option("--compare",
+                      type="string", dest="COMPARE", default=None,
+                      help="Compare the results against this JSON baseline")
+    parser.add_option("--threshold",
+                      type="float", dest="THRESHOLD", default=0.2,
+                      help="Flag benchmarks whose median latency grew by more than this fraction")
+
+    (options, args) = parser.parse_args()
+
+    try:
+        sizes = [int(x) for x in options.SIZES.split()]
+        gem_nums = [int(x) for x in options.GEMS.split()]
+    except ValueError:
+        print "Sizes and gem numbers must be integers. Terminating"
+        sys.exit(1)
+    names = options.BENCH.split(',')
+    unknown = set(names) - set([name for name, bench in BENCHMARKS])
+    if unknown:
+        print "Unknown benchmarks: %s. Terminating" %', '.join(sorted(unknown))
+        sys.exit(1)
+
+    results = runBenchmarks(sizes, gem_nums, names, options.BOARDS, options.ROUNDS)
+
+    if options.SAVE:
+        file_obj = open(options.SAVE, 'w')
+        json.dump({'python': platform.python_version(),
+                   'date': datetime.datetime.now().isoformat(),
+                   'boards': options.BOARDS,
+                   'rounds': options.ROUNDS,
+                   'results': results}, file_obj, indent=1, sort_keys=True)
+        file_obj.close()
+        print
+        print "Saved baseline to %s" %options.SAVE
+
+    if options.COMPARE:
+        file_obj = open(options.COMPARE)
+        baseline = json.load(file_obj)['results']
+        file_obj.close()
+        print
+        slower = compareResults(results, baseline, options.THRESHOLD)
+        print
+        if slower:
+            print "%d benchmark(s) slower than the baseline by more than %.0f%%" %(len(slower), 100 * options.THRESHOLD)
+            sys.exit(1)
+        print "No benchmark is slower than the baseline by more than %.0f%%" %(100 * options.THRESHOLD)
@@ -0,0 +1,102 @@
+# Gemgem - game trace replay
+# by Daniel Hadar & Oren Samuel
+# Written for 2014-2015 Intro to AI course
+# Hebrew University of Jerusalem
+
+"""
+Lists and replays the games recorded by gemgem.py --record.
+
+A trace file holds one frame per game with its initial board and every
+swap made, along with the gems that fell after it, so any board of any
+game can be rebuilt without running the solver. Games are looked up by
+their base seed and game number, by scanning only the frame headers.
+
+For example:
+python gemgem.py -q -n 1000 -a 2 --seed 7 --record games.trace
+python gemgem_replay.py games.trace
+python gemgem_replay.py games.trace --game 42 --move 10
+python gemgem_replay.py games.trace --game 42 --graphics
+"""
+
+import sys
+from optparse import OptionParser
+
+import gemgem
+
+
+def listGames(path):
+    print "%10s %6s %6s %5s %6s %6s %7s %6s" %('seed', 'game', 'board', 'gems', 'algo', 'goal', 'score', 'status')
+    ngames = 0
+    for offset, frame, payload in gemgem.readGameTraces(path):
+        magic, seed, game_index, width, height, num_gems, algo_number, goal_score, score, size = frame
+        print "%10d %6d %6s %5d %6d %6d %7d %6s" %(seed, game_index, '%dx%d' %(width, height), num_gems,
+                                                  algo_number, goal_score, score,
+                                                  'win' if score >= goal_score else 'lose')
+        ngames += 1
+    print
+    print "%d games" %ngames
+
+def configure(trace):
+    # gemgem.py keeps the board configuration in module globals.
+    gemgem.setBoardSize(trace.width, trace.height)
+    gemgem.NUMGEMIMAGES = trace.num_gems
+    gemgem.GOAL_SCORE = trace.goal_score
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog TRACE_FILE [options]")
+    parser.add_option("--game",
+                      type="int", dest="GAME", default=None,
+                      help="Game number to replay (default - list the games)")
+    parser.add_option("--seed",
+                      type="int", dest="SEED", default=None,
+                      help="Base seed of the game to replay, if the file holds several runs")
+    parser.add_option("--move",
+                      type="int", dest="MOVE", default=None,
+                      help="Only print the board after this many moves")
+    parser.add_option("--graphics",
+                      action="store_true", dest="GRAPHICS", default=False,
+                      help="Show the replay in the game window")
+    parser.add_option("-f", "--fps",
+                      type="int", dest="USER_FPS", default=30,
+                      help="Animation FPS of the graphic replay")
+    parser.add_option("--fast-forward",
+                      action="store_true", dest="FAST_FORWARD", default=False,
+                      help="Skip the animations of the graphic replay and only show the board after each move")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        print "Expected a single trace file. Terminating"
+        parser.print_help()
+        sys.exit(1)
+    path = args[0]
+
+    if options.GAME is None:
+        listGames(path)
+        sys.exit(0)
+
+    matches = [(key, offset) for key, offset in gemgem.getTraceIndex(path).items()
+               if key[1] == options.GAME and options.SEED in (None, key[0])]
+    if not matches:
+        print "Game %d is not in %s. Terminating" %(options.GAME, path)
+        sys.exit(1)
+    if len(matches) > 1:
+        print "Game %d was recorded with several seeds (%s); choose one with --seed. Terminating" \
+              %(options.GAME, ', '.join([str(key[0]) for key, offset in sorted(matches)]))
+        sys.exit(1)
+
+    trace = gemgem.loadGameTrace(path, matches[0][1])
+    configure(trace)
+    if options.GRAPHICS:
+        gemgem.FPS = options.USER_FPS
+        gemgem.FASTFORWARD = options.FAST_FORWARD
+        gemgem.initGraphics()
+
+    print "Game %d of seed %d: %d moves, %d points" %(trace.game_index, trace.seed, len(trace.moves), trace.score)
+    for moves, score, board in gemgem.replayGame(trace, simulation=not options.GRAPHICS):
+        if options.MOVE is not None and moves != options.MOVE:
+            continue
+        print
+        print "After %d moves, %d points:" %(moves, score)
+        gemgem.printBoard(board)
@@ -0,0 +1,352 @@
+# Gemgem - heuristic weight tuner
+# by Daniel Hadar & Oren Samuel
+# Written for 2014-2015 Intro to AI course
+# Hebrew University of Jerusalem
+
+"""
+Searches for good heuristic weights (the -w "S P M D T" of gemgem.py) for
+the HGS and L-BFS solvers.
+
+The search has two stages:
+  - Sampling: SAMPLES weight vectors are drawn from [LOW, HIGH] in each
+    dimension, either uniformly at random or by Latin hypercube sampling,
+    which spreads the samples evenly over every single weight.
+  - Refinement: a pattern search around the best weights so far. Every
+    round evaluates the weights one step up and one step down in each
+    dimension; the best of them becomes the new center if it is better,
+    and otherwise the step is halved.
+
+Every weight vector is evaluated on the same seeded games (game i is
+seeded with SEED + i, as in gemgem.py), so the comparisons are not blurred
+by the luck of the boards. Games are played in rounds of ROUND_GAMES games,
+and after each round a vector is dropped if the mean of its games is more
+than STOP_SIGMA standard errors below the best fully evaluated vector.
+
+The objective of a game is its points per swap if it reached the goal
+score, and 0 otherwise (efficiency), or just 1 for a win and 0 otherwise
+(wins). The best vector has the highest mean objective.
+
+Games of all the weight vectors being evaluated are played in a pool of
+WORKERS processes. Every game played is written to the output file in the
+CSV format of gemgem.py, so the w_* columns tell the vectors apart.
+
+For example:
+python gemgem_tune.py -a 2 -s 6 -g 4 -c 100 --samples 40 --games 50 --workers 8 -O tune.csv
+"""
+
+import random, sys, signal, multiprocessing
+from collections import deque
+from optparse import OptionParser
+
+import gemgem
+
+TUNE_ALGOS = {2: gemgem.SMART_GREEDY, 3: gemgem.LBFS}
+OBJECTIVES = ('efficiency', 'wins')
+
+
+class Evaluation(object):
+    # The games played so far with one weight vector.
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.stats = gemgem.RunningStats() # of the game objectives
+        self.next_game = 1
+        self.pending = 0
+        self.stopped = False
+
+    def getStdErr(self):
+        if self.stats.count < 2:
+            return float('inf')
+        return self.stats.getSampleStd() / self.stats.count ** 0.5
+
+    def __str__(self):
+        return '"%s"' %' '.join(['%.3f' %w for w in self.weights])
+
+
+class Tuner(object):
+
+    def __init__(self, algo, objective, ngames, round_games, stop_sigma, workers, seed, writer,
+                 cache_mb=0):
+        self.algo = algo
+        self.objective = objective
+        self.ngames = ngames
+        self.round_games = round_games
+        self.stop_sigma = stop_sigma
+        self.workers = workers
+        self.seed = seed
+        self.writer = writer
+        self.cache_mb = cache_mb
+        self.evaluations = {} # by rounded weights
+        self.best = None
+        self.games_played = 0
+        self.pool = None
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers, initWorker)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+    def submit(self, evaluation):
+        # Starts the evaluation's next game, and returns its async result.
+        args = (self.algo, evaluation.weights, self.cache_mb, evaluation.next_game, self.seed)
+        evaluation.next_game += 1
+        evaluation.pending += 1
+        if self.pool is None:
+            return FinishedResult(playTuneGame(*args))
+        return self.pool.apply_async(playTuneGame, args)
+
+    def evaluate(self, weight_list):
+        # Evaluates the given weight vectors together, racing them against
+        # the best vector. Vectors that were evaluated before are not
+        # played again. Returns the evaluations.
+        evaluations = []
+        for weights in weight_list:
+            key = tuple([round(w, 6) for w in weights])
+            if key not in self.evaluations:
+                self.evaluations[key] = Evaluation(key)
+                evaluations.append(self.evaluations[key])
+
+        # Games still to be started, and games in progress, in order.
+        queue = deque()
+        for evaluation in evaluations:
+            queue.extend([evaluation] * min(self.round_games, self.ngames))
+        pending = deque()
+        while queue or pending:
+            while queue and len(pending) < 2 * self.workers:
+                evaluation = queue.popleft()
+                pending.append((evaluation, self.submit(evaluation)))
+            evaluation, result = pending.popleft()
+            self.addGame(evaluation, result.get(gemgem.POOL_TIMEOUT))
+            if evaluation.pending == 0:
+                queue.extend([evaluation] * self.getNextRound(evaluation))
+        return evaluations
+
+    def addGame(self, evaluation, result):
+        game_index, score, moves, seconds, log_record = result
+        evaluation.pending -= 1
+        evaluation.stats.add(self.getObjective(score, moves))
+        self.writer.write(gemgem.formatLogLine(log_record) + '\n')
+        self.games_played += 1
+
+    def getObjective(self, score, moves):
+        if score < gemgem.GOAL_SCORE:
+            return 0
+        if self.objective == 'wins':
+            return 1
+        return score / float(max(moves, 1))
+
+    def getNextRound(self, evaluation):
+        # Returns the number of games to play next with the evaluation,
+        # which has no games in progress: 0 if it is done or stopped.
+        played = evaluation.next_game - 1
+        if played >= self.ngames:
+            if self.best is None or evaluation.stats.mean > self.best.stats.mean:
+                self.best = evaluation
+                print "New best: %s, mean objective %.4f" %(evaluation, evaluation.stats.mean)
+            return 0
+        if self.best is not None:
+            bound = evaluation.stats.mean + self.stop_sigma * evaluation.getStdErr()
+            if bound < self.best.stats.mean:
+                evaluation.stopped = True
+                return 0
+        return min(self.round_games, self.ngames - played)
+
+    def getFinished(self):
+        return [e for e in self.evaluations.values() if not e.stopped]
+
+
+class FinishedResult(object):
+    # Stands in for a pool's async result when games run in this process.
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+
+def initWorker():
+    # Ctrl-C is left to the main process, which terminates the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def playTuneGame(algo, weights, cache_mb, game_index, seed):
+    # Plays one headless game and returns its result tuple, without the
+    # per-decision metrics, which the tuner does not use.
+    solver = gemgem.Solver(False, algo, list(weights), cache_mb)
+    return gemgem.playGame(game_index, seed, False, solver, True)[:5]
+
+
+#### Sampling ####
+
+def getRandomSamples(nsamples, low, high, rng):
+    return [[rng.uniform(low, high) for i in range(5)] for j in range(nsamples)]
+
+def getLatinHypercubeSamples(nsamples, low, high, rng):
+    # Every weight's range is split into nsamples equal strata, and each
+    # stratum of each weight is used by exactly one sample.
+    columns = []
+    for i in range(5):
+        strata = range(nsamples)
+        rng.shuffle(strata)
+        columns.append([low + (high - low) * (s + rng.random()) / nsamples for s in strata])
+    return [list(sample) for sample in zip(*columns)]
+
+SAMPLERS = {'random': getRandomSamples, 'lhs': getLatinHypercubeSamples}
+
+def getNeighbors(weights, step, low, high):
+    # The weights one step up and one step down in each dimension,
+    # clipped to [low, high].
+    neighbors = []
+    for i in range(len(weights)):
+        for sign in (1, -1):
+            neighbor = list(weights)
+            neighbor[i] = min(high, max(low, neighbor[i] + sign * step))
+            if neighbor != list(weights):
+                neighbors.append(neighbor)
+    return neighbors
+
+
+def tune(tuner, samples, low, high, step, min_step, refine_rounds):
+    # Runs both stages, and returns the best evaluation.
+    print "Sampling %d weight vectors" %len(samples)
+    tuner.evaluate(samples)
+
+    for i in range(refine_rounds):
+        if step < min_step or tuner.best is None:
+            break
+        center = tuner.best
+        print "Refinement round %d around %s, step %.4f" %(i + 1, center, step)
+        tuner.evaluate(getNeighbors(center.weights, step, low, high))
+        if tuner.best is center:
+            step /= 2.0
+    return tuner.best
+
+def printSummary(tuner, top):
+    finished = sorted(tuner.getFinished(), key=lambda e: e.stats.mean, reverse=True)
+    print
+    print "%d weight vectors evaluated (%d stopped early), %d games played" \
+          %(len(tuner.evaluations), len(tuner.evaluations) - len(finished), tuner.games_played)
+    print "%-40s %6s %10s %10s" %('weights', 'games', 'objective', 'std err')
+    for evaluation in finished[:top]:
+        print "%-40s %6d %10.4f %10.4f" %(evaluation, evaluation.stats.count,
+                                         evaluation.stats.mean, evaluation.getStdErr())
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-a", "--algorithm",
+                      type="int", dest="ALGO", default=2,
+                      help="Algorithm to tune: 2=HGS, 3=L-BFS")
+    parser.add_option("-s", "--size",
+                      type="int", dest="BOARD_SIZE", default=6,
+                      help="Size of game board side (4..%d)" %gemgem.MAXBOARDSIZE)
+    parser.add_option("-g", "--gems",
+                      type="int", dest="GEM_NUM", default=4,
+                      help="Number of gem types (4..7)")
+    parser.add_option("-c", "--score",
+                      type="int", dest="GOAL", default=100,
+                      help="Target (limit) score")
+    parser.add_option("-O", "--output",
+                      type="string", dest="LOGFILE", default="gemgem_tune.csv",
+                      help="Log file of all the games played, in the CSV format of gemgem.py")
+    parser.add_option("--objective",
+                      type="choice", choices=OBJECTIVES, dest="OBJECTIVE", default='efficiency',
+                      help="Game objective: efficiency (points per swap of won games) or wins")
+    parser.add_option("--sampling",
+                      type="choice", choices=sorted(SAMPLERS), dest="SAMPLING", default='lhs',
+                      help="Sampling of the first stage: lhs (Latin hypercube) or random")
+    parser.add_option("--samples",
+                      type="int", dest="SAMPLES", default=30,
+                      help="Number of weight vectors sampled in the first stage")
+    parser.add_option("--low",
+                      type="float", dest="LOW", default=0,
+                      help="Lowest value of each weight")
+    parser.add_option("--high",
+                      type="float", dest="HIGH", default=1,
+                      help="Highest value of each weight")
+    parser.add_option("--games",
+                      type="int", dest="GAMES", default=50,
+                      help="Number of games a weight vector is evaluated on")
+    parser.add_option("--round-games",
+                      type="int", dest="ROUND_GAMES", default=10,
+                      help="Number of games between early stopping checks")
+    parser.add_option("--stop-sigma",
+                      type="float", dest="STOP_SIGMA", default=2,
+                      help="Stop a weight vector when its mean is this many standard errors below the best")
+    parser.add_option("--refine-rounds",
+                      type="int", dest="REFINE_ROUNDS", default=10,
+                      help="Maximal number of refinement rounds")
+    parser.add_option("--step",
+                      type="float", dest="STEP", default=None,
+                      help="First refinement step (default - a quarter of the weight range)")
+    parser.add_option("--min-step",
+                      type="float", dest="MIN_STEP", default=0.01,
+                      help="Refinement stops when the step is smaller than this")
+    parser.add_option("--workers",
+                      type="int", dest="WORKERS", default=multiprocessing.cpu_count(),
+                      help="Number of processes to run games in")
+    parser.add_option("--seed",
+                      type="int", dest="SEED", default=0,
+                      help="Base random seed of the games and the sampling")
+    parser.add_option("--cache-mb",
+                      type="float", dest="CACHE_MB", default=0,
+                      help="Memory cap of each solver's move cache in MB. Set to 0 to disable")
+
+    (options, args) = parser.parse_args()
+
+    if options.ALGO not in TUNE_ALGOS:
+        print "Algorithm must be 2 (HGS) or 3 (L-BFS). Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    if options.BOARD_SIZE < 4 or options.BOARD_SIZE > gemgem.MAXBOARDSIZE or options.GEM_NUM < 4 or options.GEM_NUM > 7:
+        print "Board size must be in the range 4..%d and number of gem types in 4..7. Terminating" %gemgem.MAXBOARDSIZE
+        parser.print_help()
+        sys.exit(1)
+
+    if options.SAMPLES < 1 or options.GAMES < 1 or options.ROUND_GAMES < 1 or options.WORKERS < 1:
+        print "Samples, games, round games and workers must be at least 1. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    if options.LOW >= options.HIGH:
+        print "The lowest weight must be smaller than the highest. Terminating"
+        parser.print_help()
+        sys.exit(1)
+
+    # gemgem.py keeps the game configuration in module globals; worker
+    # processes inherit them.
+    gemgem.setBoardSize(options.BOARD_SIZE, options.BOARD_SIZE)
+    gemgem.NUMGEMIMAGES = options.GEM_NUM
+    gemgem.GOAL_SCORE = options.GOAL
+
+    step = options.STEP
+    if step is None:
+        step = (options.HIGH - options.LOW) / 4.0
+    rng = random.Random(options.SEED)
+    samples = SAMPLERS[options.SAMPLING](options.SAMPLES, options.LOW, options.HIGH, rng)
+
+    writer = gemgem.ResultWriter(options.LOGFILE, gemgem.getLogHeader())
+    tuner = Tuner(TUNE_ALGOS[options.ALGO], options.OBJECTIVE, options.GAMES, options.ROUND_GAMES,
+                  options.STOP_SIGMA, options.WORKERS, options.SEED, writer, options.CACHE_MB)
+    try:
+        best = tune(tuner, samples, options.LOW, options.HIGH, step, options.MIN_STEP, options.REFINE_ROUNDS)
+        tuner.close()
+    except KeyboardInterrupt:
+        print "Interrupted, reporting the results so far"
+        tuner.terminate()
+        best = tuner.best
+    finally:
+        writer.close()
+
+    printSummary(tuner, 10)
+    if best is not None:
+        print
+        print "Best weights: -w %s (mean objective %.4f over %d games)" %(best, best.stats.mean, best.stats.count)
@@ -0,0 +1,172 @@
+# Gemgem - vectorized headless simulator
+# by Daniel Hadar & Oren Samuel
+# Written for 2014-2015 Intro to AI course
+# Hebrew University of Jerusalem
+
+"""
+Plays many headless games of Gemgem at once with NumPy, for gathering
+statistics quickly. All the boards of a batch are kept in one int8 array
+of shape (ngames, BOARDWIDTH, BOARDHEIGHT), indexed [game, x, y] like the
+boards in gemgem.py, and matching, gravity, refills and scoring are done
+as whole-array operations across all the games.
+
+The rules are the ones of gemgem.py:
+  - A match is a vertical or horizontal run of 3 or more identical gems
+    (findMatchingGems), and a move scores one point per matched gem.
+  - Matched gems are removed, the gems above them fall down
+    (pullDownAllGems) and the empty spaces are refilled with random gems
+    (fillEmptySpaces), until there are no more matches (perform_move).
+  - The first board of a game has no two identical neighboring gems.
+  - A game ends when the goal score is reached or no swap makes a match.
+
+Only the SGS policy is vectorized so far: it picks the swap whose first
+match is the largest, breaking ties at random.
+
+This module needs NumPy, which gemgem.py itself does not.
+"""
+
+import numpy as np
+
+EMPTY_SPACE = -1 # same value as in gemgem.py
+
+
+class VectorizedGames(object):
+
+    def __init__(self, ngames, width, height, num_gems, goal_score, seed=None):
+        self.ngames = ngames
+        self.width = width
+        self.height = height
+        self.num_gems = num_gems
+        self.goal_score = goal_score
+        self.rng = np.random.RandomState(seed)
+
+        self.scores = np.zeros(ngames, dtype=np.int32)
+        self.moves = np.zeros(ngames, dtype=np.int32)
+        self.active = np.ones(ngames, dtype=bool)
+        self.swaps = getSwapList(width, height)
+        self.boards = self.getFirstBoards()
+
+    def getFirstBoards(self):
+        # Fills the boards the way fillEmptySpaces() does for the first drop:
+        # column by column, bottom up, each gem differs from the gem below
+        # it and the gem to its left.
+        boards = np.empty((self.ngames, self.width, self.height), dtype=np.int8)
+        games = np.arange(self.ngames)
+        for x in range(self.width):
+            for y in range(self.height - 1, -1, -1):
+                allowed = np.ones((self.ngames, self.num_gems), dtype=bool)
+                if y + 1 < self.height:
+                    allowed[games, boards[:, x, y + 1]] = False
+                if x > 0:
+                    allowed[games, boards[:, x - 1, y]] = False
+                # The largest of i.i.d. uniform draws is a uniform pick.
+                draws = self.rng.random_sample(allowed.shape) * allowed
+                boards[:, x, y] = draws.argmax(axis=1)
+        return boards
+
+    def run(self, policy=None):
+        # Plays all the games to the end. Returns the scores and the
+        # number of moves of each game.
+        if policy is None:
+            policy = greedyPolicy
+        while self.active.any():
+            games = np.flatnonzero(self.active)
+            swap_scores = getSwapScores(self.boards[games], self.swaps)
+
+            can_move = swap_scores.max(axis=1) > 0
+            self.active[games[~can_move]] = False
+            games = games[can_move]
+            if not len(games):
+                break
+
+            chosen = policy(swap_scores[can_move], self.rng)
+            self.performSwaps(games, chosen)
+            self.active[games[self.scores[games] >= self.goal_score]] = False
+        return self.scores, self.moves
+
+    def performSwaps(self, games, chosen):
+        # Swaps the chosen gems on each of the given games' boards, then
+        # removes matches and refills until every board is settled.
+        boards = self.boards[games]
+        rows = np.arange(len(games))
+        x1, y1, x2, y2 = self.swaps[chosen].T
+        first = boards[rows, x1, y1]
+        boards[rows, x1, y1] = boards[rows, x2, y2]
+        boards[rows, x2, y2] = first
+
+        gained = np.zeros(len(games), dtype=np.int32)
+        while True:
+            matched = getMatchMask(boards)
+            counts = matched.sum(axis=(1, 2))
+            if not counts.any():
+                break
+            gained += counts
+            boards[matched] = EMPTY_SPACE
+            boards = pullDownAllGems(boards)
+            self.fillEmptySpaces(boards)
+
+        self.boards[games] = boards
+        self.scores[games] += gained
+        self.moves[games] += 1
+
+    def fillEmptySpaces(self, boards):
+        empty = boards == EMPTY_SPACE
+        boards[empty] = self.rng.randint(0, self.num_gems, size=empty.sum())
+
+
+def getSwapList(width, height):
+    # All the RIGHT and DOWN swaps, as an array of (x1, y1, x2, y2) rows.
+    swaps = []
+    for y in range(height):
+        for x in range(width):
+            if x + 1 < width:
+                swaps.append((x, y, x + 1, y))
+            if y + 1 < height:
+                swaps.append((x, y, x, y + 1))
+    return np.array(swaps, dtype=np.intp)
+
+def getMatchMask(boards):
+    # Returns a boolean array marking every gem that is part of a run of 3
+    # or more identical gems - the spaces findMatchingGems() would return.
+    filled = boards != EMPTY_SPACE
+    matched = np.zeros(boards.shape, dtype=bool)
+
+    horizontal = (boards[:, :-2, :] == boards[:, 1:-1, :]) & \
+                 (boards[:, 1:-1, :] == boards[:, 2:, :]) & filled[:, :-2, :]
+    matched[:, :-2, :] |= horizontal
+    matched[:, 1:-1, :] |= horizontal
+    matched[:, 2:, :] |= horizontal
+
+    vertical = (boards[:, :, :-2] == boards[:, :, 1:-1]) & \
+               (boards[:, :, 1:-1] == boards[:, :, 2:]) & filled[:, :, :-2]
+    matched[:, :, :-2] |= vertical
+    matched[:, :, 1:-1] |= vertical
+    matched[:, :, 2:] |= vertical
+    return matched
+
+def pullDownAllGems(boards):
+    # Returns the boards with the gems of each column pulled down to the
+    # bottom, keeping their order. A stable sort of "is not empty" along
+    # each column puts the empty spaces on top.
+    order = np.argsort(boards != EMPTY_SPACE, axis=2, kind='mergesort')
+    ngames, width, height = boards.shape
+    return boards[np.arange(ngames)[:, None, None], np.arange(width)[None, :, None], order]
+
+def getSwapScores(boards, swaps):
+    # Returns an (ngames, nswaps) array with the number of gems the first
+    # match of every swap removes (0 if the swap makes no match), which is
+    # the score perform_single_move() gives without random falls.
+    rows = np.arange(len(boards))
+    scores = np.zeros((len(boards), len(swaps)), dtype=np.int32)
+    for i, (x1, y1, x2, y2) in enumerate(swaps):
+        swapped = boards.copy()
+        swapped[rows, x1, y1] = boards[rows, x2, y2]
+        swapped[rows, x2, y2] = boards[rows, x1, y1]
+        scores[:, i] = getMatchMask(swapped).sum(axis=(1, 2))
+    return scores
+
+def greedyPolicy(swap_scores, rng):
+    # SGS: the swap with the highest score, with ties broken at random
+    # (like shuffling the moves before taking the max).
+    noise = rng.random_sample(swap_scores.shape)
+    return (swap_scores + noise).argmax(axis=1)